@@ -0,0 +1,165 @@
+"""
+Benchmarks for building, comparing and serializing figures at scale.
+
+Run with e.g.
+    python benchmark_figures.py --lines 1,100 --points 1000,100000 --output results.json
+
+Every combination of the sizes given is benchmarked, and the timings are
+written to a json file so that they can be compared between releases.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import matplotlib
+from matplotlib import pyplot as plt
+import test_figures
+from test_figures import (assert_similar_figures, Figure, FigureOutput,
+                          load_figures)
+
+
+def make_figure(lines, points, patches, scatter, seed=0):
+    """
+    Make a matplotlib figure with one axis holding `lines` lines of `points`
+    points, a histogram with `patches` bars and a scatter plot of `scatter`
+    points.
+    """
+    rng = np.random.default_rng(seed)
+    fig, ax = plt.subplots()
+    x = np.arange(points)
+    for i in range(lines):
+        ax.plot(x, rng.normal(size=points) + i, label=f"line {i}")
+    if patches:
+        ax.hist(rng.normal(size=10 * patches), bins=patches)
+    if scatter:
+        ax.scatter(rng.random(scatter), rng.random(scatter))
+    ax.set_title("Benchmark")
+    ax.set_xlabel("x")
+    ax.set_ylabel("y")
+    if lines:
+        ax.legend()
+    return fig
+
+
+def time_call(func, repeat):
+    """Call `func` `repeat` times, returning statistics of the run times"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": float(np.median(times)),
+            "mean": float(np.mean(times)), "repeat": repeat}
+
+
+def benchmark_case(lines, points, patches, scatter, repeat=3):
+    """
+    Benchmark one size of figure
+
+    Returns:
+        Dict[str, dict]: The timing statistics of each benchmark
+    """
+    fig = make_figure(lines, points, patches, scatter)
+    other_fig = make_figure(lines, points, patches, scatter)
+    ref = Figure(fig).extract()
+    results = {}
+    results["figure_extract"] = time_call(lambda: Figure(fig).extract(), repeat)
+    with np.printoptions(threshold=sys.maxsize):
+        results["figure_repr"] = time_call(lambda: repr(ref), repeat)
+        source = repr(ref)
+
+    # loading a python reference means compiling and running its source,
+    # with the names that FigureOutput imports at the top of the file
+    namespace = vars(test_figures).copy()
+    namespace.update(np=np, array=np.array, uint8=np.uint8, float64=np.float64)
+    results["python_reference_load"] = time_call(
+        lambda: eval(compile(source, "<reference>", "eval"), namespace), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        py_file = os.path.join(tmp_dir, "ref.py")
+        npz_file = os.path.join(tmp_dir, "ref.npz")
+
+        def write(file_name):
+            with FigureOutput(file_name) as output:
+                output.write_to_file(fig, "fig")
+
+        results["python_reference_write"] = time_call(lambda: write(py_file), repeat)
+        results["binary_reference_write"] = time_call(lambda: write(npz_file), repeat)
+        results["binary_reference_load"] = time_call(lambda: load_figures(npz_file),
+                                                     repeat)
+        results["binary_reference_load_mmap"] = time_call(
+            lambda: load_figures(npz_file, mmap=True), repeat)
+        results["python_reference_bytes"] = os.path.getsize(py_file)
+        results["binary_reference_bytes"] = os.path.getsize(npz_file)
+
+    results["compare_all"] = time_call(
+        lambda: assert_similar_figures(ref, Figure(other_fig)), repeat)
+    results["compare_data"] = time_call(
+        lambda: assert_similar_figures(ref, Figure(other_fig), ("x_data", "y_data")),
+        repeat)
+    plt.close(fig)
+    plt.close(other_fig)
+    return results
+
+
+def run_benchmarks(lines=(10,), points=(1000,), patches=(100,), scatter=(1000,),
+                   repeat=3):
+    """
+    Benchmark every combination of the sizes given
+
+    Returns:
+        dict: The environment the benchmarks ran in, and a list of cases,
+        each with its sizes and timings
+    """
+    cases = []
+    for case in itertools.product(lines, points, patches, scatter):
+        sizes = dict(zip(("lines", "points", "patches", "scatter"), case))
+        cases.append({"sizes": sizes, "results": benchmark_case(**sizes, repeat=repeat)})
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "matplotlib": matplotlib.__version__,
+            "machine": platform.machine(),
+        },
+        "cases": cases,
+    }
+
+
+def _sizes(arg):
+    return tuple(int(size) for size in arg.split(","))
+
+
+if __name__ == "__main__":
+    matplotlib.use("Agg")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=_sizes, default=(10,),
+                        help="comma separated numbers of lines")
+    parser.add_argument("--points", type=_sizes, default=(1000,),
+                        help="comma separated numbers of points per line")
+    parser.add_argument("--patches", type=_sizes, default=(100,),
+                        help="comma separated numbers of histogram bars")
+    parser.add_argument("--scatter", type=_sizes, default=(1000,),
+                        help="comma separated numbers of scatter points")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="the number of times to time each benchmark")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="the json file to write the results to")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.lines, args.points, args.patches, args.scatter,
+                             args.repeat)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    for case in results["cases"]:
+        print(case["sizes"])
+        for name, result in case["results"].items():
+            if isinstance(result, dict):
+                print(f"    {name}: {result['median']:.4g} s")
+            else:
+                print(f"    {name}: {result}")
@@ -1,18 +1,59 @@
 import numpy as np
 import matplotlib
 from matplotlib import pyplot as plt, _pylab_helpers
-from functools import total_ordering
+from matplotlib.backend_bases import FigureCanvasBase
+from matplotlib.text import Text
+from matplotlib.path import Path
+from functools import cached_property, partial, total_ordering
+from collections import Counter, namedtuple, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import hashlib
+import datetime
+import importlib.util
+import inspect
+import io
+import json
 import math
+import numbers
+import multiprocessing
+import os
 import re
-
-
-def assert_similar_figures(ref_fig, other_fig, attrs=None, tol=1e-5):
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import warnings
+import zipfile
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    # lines are matched greedily instead
+    linear_sum_assignment = None
+
+
+def assert_similar_figures(ref_fig, other_fig, attrs=None, tol=1e-5,
+                           ordered_scatter=True, matching="optimal"):
     """
     Assert that two figures are similar.
 
     Parameters:
         ref_fig (matplotlib figure): The reference figure
         other_fig (matplotlib figure): The figure to compare to the reference
+        ordered_scatter (bool): If False, the points in a scatter plot may be
+            plotted in any order
+        matching (str): How the lines, scatter plots and patches of the
+            figures are paired up. "sorted" pairs them in sorted order.
+            "optimal" (the default) does the same, then pairs any which
+            aren't similar again, so that they are as close as possible, as
+            small differences can change the order they sort in.
 
     Raises:
         AssertionError if the figures are dissimilar
@@ -21,57 +62,539 @@ def assert_similar_figures(ref_fig, other_fig, attrs=None, tol=1e-5):
         ref_fig = Figure(ref_fig)
     if not isinstance(other_fig, Figure):
         other_fig = Figure(other_fig)
-    ref_fig.assert_similar(other_fig, attrs, tol=tol)
+    ref_fig.assert_similar(other_fig, attrs, tol=tol,
+                           ordered_scatter=ordered_scatter, matching=matching)
+
+def diff_figures(ref_fig, other_fig, attrs=None, tol=1e-5, ordered_scatter=True,
+                 matching="optimal"):
+    """
+    Find every difference between two figures, rather than only the first
+    as `assert_similar_figures` does. The parameters are the same.
+
+    Returns:
+        List[Difference]: The differences, in the order they were found, which
+        is empty if the figures are similar
+    """
+    if not isinstance(ref_fig, Figure):
+        ref_fig = Figure(ref_fig)
+    if not isinstance(other_fig, Figure):
+        other_fig = Figure(other_fig)
+    return ref_fig.diff(other_fig, attrs, tol=tol,
+                        ordered_scatter=ordered_scatter, matching=matching)
+
+Difference = namedtuple("Difference",
+                        ("path", "attr", "expected", "found", "error", "message"))
+Difference.__doc__ = """
+A difference between two figures found by `diff_figures`
+
+Attributes:
+    path (tuple): Where the difference is, e.g. () for the figure itself,
+        ("axes", 0) for its first axis, or ("axes", 0, "lines", 2) for the
+        third line of that axis (in sorted order)
+    attr (str): The attribute which differs, e.g. "y_data"
+    expected: The value in the reference
+    found: The value in the other figure
+    error (float): The largest absolute difference, for numbers and numeric
+        data of the same shape, otherwise None
+    message (str): The message `assert_similar_figures` raises for it
+"""
+
+def score_figures(ref_fig, other_fig, rubric, tol=1e-5, ordered_scatter=True,
+                  matching="optimal"):
+    """
+    Give partial credit for a figure, attribute by attribute. Every attribute
+    in the rubric is scored in one comparison of the figures.
+
+    The score of an attribute is the fraction of the items it was compared
+    for (the figure, each axis, each line, scatter plot or patch) where it
+    was similar. If the reference and the other figure have different
+    numbers of axes, lines, scatter plots or patches, their attributes score
+    0 as the items can't be paired.
+
+    Parameters:
+        ref_fig, other_fig: The figures, as for `assert_similar_figures`
+        rubric (Dict[str, float]): The weight of each attribute to score.
+            The attributes are those of `Figure`, `Axis`, `Line`,
+            `PathCollection` and `PatchArray`.
+        tol, ordered_scatter, matching: As for `assert_similar_figures`
+
+    Returns:
+        FigureScore: The weighted score and the score of each attribute
+
+    Raises:
+        ValueError: If the rubric has an unknown attribute, or no weight
+    """
+    unknown = set(rubric).difference(SCORED_ATTRS)
+    if unknown:
+        raise ValueError(f"Unknown attributes in rubric: {sorted(unknown)}")
+    total_weight = sum(rubric.values())
+    if total_weight <= 0:
+        raise ValueError("The rubric must have a positive total weight")
+    if not isinstance(ref_fig, Figure):
+        ref_fig = Figure(ref_fig)
+    if not isinstance(other_fig, Figure):
+        other_fig = Figure(other_fig)
+
+    report = _DiffReport(measure=True)
+    ref_fig._diff(other_fig, tuple(rubric), tol, ordered_scatter, matching, report)
+    scores = {}
+    for attr in rubric:
+        checks = report.checks[attr]
+        # nothing to compare (e.g. no lines in either figure) is full marks
+        scores[attr] = float(1 - report.failures[attr] / checks) if checks else 1.0
+    score = sum(weight * scores[attr] for attr, weight in rubric.items())
+    errors = {attr: {"max_abs": max_abs, "rms": math.sqrt(square_sum / count)}
+              for attr, (max_abs, square_sum, count) in report.errors.items()
+              if attr in rubric}
+    return FigureScore(float(score / total_weight), scores, errors, report.differences)
+
+FigureScore = namedtuple("FigureScore", ("score", "scores", "errors", "differences"))
+FigureScore.__doc__ = """
+The partial credit given to a figure by `score_figures`
+
+Attributes:
+    score (float): The weighted mean of the scores, from 0 to 1
+    scores (Dict[str, float]): The score of each attribute in the rubric,
+        from 0 to 1
+    errors (Dict[str, dict]): For the numeric attributes in the rubric
+        (the data of lines and scatter plots, and the sizes and positions of
+        patches), the "max_abs" and "rms" difference over every value
+        compared. Data which can't be compared value by value, as it has
+        a different shape, isn't included.
+    differences (List[Difference]): Every difference found, as returned
+        by `diff_figures`
+"""
+
+class _DiffReport:
+    """
+    Collects the differences found by the `_diff` methods. If `first_only`,
+    the first difference is raised as an AssertionError instead, which is
+    how the `assert_similar` methods stop at the first difference.
+
+    Otherwise the number of times each attribute is compared is counted
+    with `checked`, and if `measure`, the errors of numeric attributes are
+    gathered with `measure_error` for `score_figures`.
+    """
+    def __init__(self, first_only=False, measure=False):
+        self.first_only = first_only
+        self.measure = measure and not first_only
+        self.differences = []
+        self.checks = Counter()
+        self.failures = Counter()
+        # attr: [largest absolute error, sum of squared errors, count]
+        self.errors = {}
+        # the difference raised, for a report made by `diff_pair`
+        self.error = None
+
+    @property
+    def failed(self):
+        """Whether a difference has been found"""
+        return self.error is not None or bool(self.differences)
+
+    def diff_pair(self, diff, item, other_item, path):
+        """
+        Compare a pair of items with `diff(item, other_item, report, path)`
+        into a new report like this one, so that it can be kept with
+        `merge` or thrown away if the items are paired again.
+        """
+        pair_report = _DiffReport(self.first_only, self.measure)
+        try:
+            diff(item, other_item, pair_report, path)
+        except AssertionError as error:
+            pair_report.error = error
+        return pair_report
+
+    def merge(self, other):
+        """Add what a report made by `diff_pair` found to this report"""
+        if other.error is not None:
+            raise other.error
+        self.differences.extend(other.differences)
+        self.checks.update(other.checks)
+        self.failures.update(other.failures)
+        for attr, (max_abs, square_sum, count) in other.errors.items():
+            totals = self.errors.setdefault(attr, [0.0, 0.0, 0])
+            totals[0] = max(totals[0], max_abs)
+            totals[1] += square_sum
+            totals[2] += count
+
+    def checked(self, attrs, count=1, failed=0):
+        """
+        Count `count` comparisons of each of `attrs`, of which `failed` failed
+        without being added as differences.
+        """
+        if self.first_only:
+            return
+        for attr in attrs:
+            self.checks[attr] += count
+            self.failures[attr] += failed
+
+    def measure_error(self, attr, values, other_values):
+        """
+        Add the errors between numeric arrays of the same shape to the
+        errors of `attr`. Values which are NaN in both are ignored.
+        """
+        if not self.measure or values is None or other_values is None:
+            return
+        values, other_values = np.asarray(values), np.asarray(other_values)
+        if (values.shape != other_values.shape
+                or values.dtype.kind not in "biuf"
+                or other_values.dtype.kind not in "biuf"):
+            return
+        with np.errstate(invalid="ignore"):
+            error = np.abs(values.astype(float) - other_values.astype(float))
+        error = error[~(np.isnan(values) & np.isnan(other_values))]
+        if not error.size:
+            return
+        # one-sided NaN is an infinite error
+        error[np.isnan(error)] = np.inf
+        totals = self.errors.setdefault(attr, [0.0, 0.0, 0])
+        totals[0] = max(totals[0], float(error.max()))
+        totals[1] += float(np.dot(error, error))
+        totals[2] += error.size
+
+    def add(self, path, attr, expected, found, message, error=None):
+        """
+        Record a difference. `error` may be a function returning the error,
+        which is only called if the difference is kept.
+        """
+        if self.first_only:
+            raise AssertionError(message)
+        for name in attr.split(", "):
+            self.failures[name] += 1
+        if callable(error):
+            error = error()
+        self.differences.append(Difference(tuple(path), attr, expected, found,
+                                           error, message))
 
 def capture_figures(func, *args, **kwargs):
     """ 
     Runs a function which generates figures (where the function doesn't return
     the figures), gets a handle to the figures and returns them. 
 
+    The function is run in `isolated_figures`, so it only sees the figures
+    it makes, and several threads can capture figures at once.
+
     Parameters:
         func (callable): The function which generates figures
         
     Returns:
         Tuple[matplotlib.figure.Figure,...]: Handles to the figures generated by the
         function
+        Any: What the function returned
+
+    Raises:
+        CaptureError: If the function raised an exception
     """
-    # Keep track of the original figures
-    original_figs = _pylab_helpers.Gcf.figs.copy()
+    # Turning interactive mode on means plt.show() is non-blocking,
+    # and won't clear the active figures on calling plt.show().
+    # Giving the function its own figures means we don't get confused by
+    # existing figures, and leaves them as they were, as if we were never here
+    with _interactive(), isolated_figures():
+        # call the function which generates the figures
+        try:
+            with _timed("capture", "figure"):
+                returns = func(*args, **kwargs)
+        except Exception as err:
+            raise CaptureError(f"{type(err).__name__}: {err}") from err
+
+        # get handles to the figures
+        figs = get_active_figures()
 
-    # determine if matplotlib is in interactive mode
-    interactive = matplotlib.is_interactive()
+    # we're done!
+    return figs, returns
 
-    # Turning interactive mode on means plt.show() is non-blocking,
-    # and won't clear the active figures on calling plt.show()
-    if not interactive:
-        plt.ion()
+def capture_figure_data(func, *args, **kwargs):
+    """
+    Like `capture_figures`, but returns the figures as extracted `Figure`
+    objects, and closes the matplotlib figures as soon as they have been
+    read. No references to them are kept, so the memory they use is freed
+    straight away, and grading many submissions doesn't grow the memory used.
 
-    # close existing figures, so that we don't get confused by them
-    plt.close("all")
+    Returns:
+        Tuple[Figure, ...]: The figures generated by the function
+        Any: What the function returned
 
-    # call the function which generates the figures
+    Raises:
+        CaptureError: If the function raised an exception, or called `exit()`
+    """
+    with _interactive(), isolated_figures():
+        try:
+            try:
+                with _timed("capture", "figure"):
+                    returns = func(*args, **kwargs)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as err:
+                # including SystemExit, if the function calls exit()
+                raise CaptureError(f"{type(err).__name__}: {err}") from err
+            figs = tuple(Figure(fig).extract() for fig in get_active_figures())
+        finally:
+            _release_figures()
+    return figs, returns
+
+def _release_figures():
+    """Close the figures pyplot manages, and clear them so they're freed sooner"""
+    for manager in _pylab_helpers.Gcf.get_all_fig_managers():
+        fig = manager.canvas.figure
+        _pylab_helpers.Gcf.destroy(manager)
+        # the artists of a figure refer to each other, so clearing them lets
+        # most of the figure be freed without waiting for the garbage collector
+        fig.clear()
+
+@contextmanager
+def isolated_figures():
+    """
+    Context manager in which the current thread has its own set of figures.
+
+    Inside it, pyplot (`plt.figure`, `plt.gcf`, `plt.close("all")` and so
+    on) only sees the figures made in the context by this thread. Other
+    threads, and this thread after the context, see the figures they had
+    before, so figures can be made in several threads at once without mixing
+    them up. The figures made in the context are forgotten by pyplot when it
+    exits, but can still be used through handles to them.
+
+    Only the figures are isolated. The rest of matplotlib's state, such as
+    interactive mode (`plt.ion`/`plt.ioff`) and `rcParams`, is shared by
+    every thread, so a function which changes it changes it for functions
+    being captured in other threads too.
+    """
+    registry = _install_figure_registry()
+    previous = getattr(registry.local, "figs", None)
+    registry.local.figs = OrderedDict()
     try:
-        returns = func(*args, **kwargs)
-    except Exception as err:
-        print(err)
-        raise Exception(err)
+        yield
+    finally:
+        registry.local.figs = previous
 
-    # get handles to the figures
-    fig_managers = _pylab_helpers.Gcf.get_all_fig_managers() 
-    figs = []
-    for fig_manager in fig_managers:
-        figs.append(fig_manager.canvas.figure)
+class _FigureRegistry(MutableMapping):
+    """
+    Stands in for `Gcf.figs`, the figure managers pyplot keeps, giving each
+    thread in `isolated_figures` its own, and other threads the shared ones.
+    """
+    def __init__(self, shared):
+        self.shared = shared
+        self.local = threading.local()
 
-    # restore interactive mode to its original state
-    if not interactive:
-        plt.ioff()
+    @property
+    def current(self):
+        figs = getattr(self.local, "figs", None)
+        return self.shared if figs is None else figs
 
-    # reset the figure manager to its original state, as if we
-    # were never here
-    _pylab_helpers.Gcf.figs = original_figs
+    def __getitem__(self, num):
+        return self.current[num]
 
-    # we're done!
-    return tuple(figs), returns
+    def __setitem__(self, num, manager):
+        self.current[num] = manager
+
+    def __delitem__(self, num):
+        del self.current[num]
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __reversed__(self):
+        return reversed(self.current)
+
+    def __len__(self):
+        return len(self.current)
+
+    def keys(self):
+        return self.current.keys()
+
+    def values(self):
+        return self.current.values()
+
+    def items(self):
+        return self.current.items()
+
+    def clear(self):
+        self.current.clear()
+
+    def copy(self):
+        return self.current.copy()
+
+    def move_to_end(self, num, last=True):
+        self.current.move_to_end(num, last)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.current!r})"
+
+_registry_lock = threading.Lock()
+
+def _install_figure_registry():
+    """Put a `_FigureRegistry` in place of `Gcf.figs`, if it isn't there already"""
+    with _registry_lock:
+        figs = _pylab_helpers.Gcf.figs
+        if not isinstance(figs, _FigureRegistry):
+            figs = _FigureRegistry(figs)
+            _pylab_helpers.Gcf.figs = figs
+        return figs
+
+_interactive_lock = threading.Lock()
+_interactive_users = 0
+_was_interactive = False
+
+@contextmanager
+def _interactive():
+    """
+    Turn on interactive mode until every thread using it is finished with
+    it, then restore it to its original state.
+
+    Interactive mode is held in `rcParams`, which matplotlib reads in many
+    places, so it can't be kept for each thread: captures in several threads
+    share it, and one which calls `plt.ioff()` turns it off for the others
+    until the last capture finishes.
+    """
+    global _interactive_users, _was_interactive
+    with _interactive_lock:
+        if _interactive_users == 0:
+            _was_interactive = matplotlib.is_interactive()
+            if not _was_interactive:
+                plt.ion()
+        _interactive_users += 1
+    try:
+        yield
+    finally:
+        with _interactive_lock:
+            _interactive_users -= 1
+            if _interactive_users == 0 and not _was_interactive:
+                plt.ioff()
+
+_no_render_lock = threading.Lock()
+_no_render_users = 0
+_rendering_functions = []
+
+@contextmanager
+def no_render():
+    """
+    Context manager in which matplotlib doesn't render figures.
+
+    `plt.show`, `plt.pause`, `Figure.savefig` and the `draw`, `draw_idle`
+    and `print_figure` methods of canvases do nothing, so code which shows or
+    saves its figures doesn't pay for rasterising them, and `plt.pause`
+    doesn't wait. Everything `Figure` reads, including tick labels, is still
+    available. Nothing is rendered in any thread while any thread is in the
+    context, and savefig doesn't write a file.
+    """
+    global _no_render_users
+    with _no_render_lock:
+        if _no_render_users == 0:
+            _stop_rendering()
+        _no_render_users += 1
+    try:
+        yield
+    finally:
+        with _no_render_lock:
+            _no_render_users -= 1
+            if _no_render_users == 0:
+                _restore_rendering()
+
+def _do_nothing(*args, **kwargs):
+    pass
+
+def _stop_rendering():
+    """Replace every function which renders figures with one which does nothing"""
+    owners = [(plt, ("show", "pause")),
+              (matplotlib.figure.Figure, ("savefig",))]
+    canvases = [FigureCanvasBase]
+    while canvases:
+        canvas = canvases.pop()
+        canvases.extend(canvas.__subclasses__())
+        owners.append((canvas, [name for name in ("draw", "draw_idle", "print_figure",
+                                                  "start_event_loop", "flush_events")
+                                if name in vars(canvas)]))
+    for owner, names in owners:
+        for name in names:
+            _rendering_functions.append((owner, name, vars(owner)[name]))
+            setattr(owner, name, _do_nothing)
+
+def _restore_rendering():
+    while _rendering_functions:
+        owner, name, function = _rendering_functions.pop()
+        setattr(owner, name, function)
+
+class CaptureError(Exception):
+    """Raised when a function run by capture_figures raises an exception"""
+
+class CaptureTimeout(CaptureError):
+    """Raised when a function run by capture_figures_sandboxed takes too long"""
+
+def capture_figures_sandboxed(func, args=(), kwargs=None, timeout=None,
+                              memory_limit=None, render=False):
+    """
+    Like `capture_figures`, but runs the function in a separate process, so
+    that it can be stopped if it takes too long or uses too much memory.
+
+    Parameters:
+        func (callable): The function which generates figures. It must be
+            picklable if processes aren't started by forking.
+        args (tuple): Positional arguments for `func`
+        kwargs (dict): Keyword arguments for `func`
+        timeout (float): Seconds to wait for `func` before killing its process
+        memory_limit (int): The most address space, in bytes, the process may
+            use. This includes the python interpreter, numpy and matplotlib.
+            Only supported where the `resource` module is available.
+        render (bool): If False, `func` is run in `no_render`, so showing
+            or saving figures does nothing (and no file is written)
+
+    Returns:
+        Tuple[Figure, ...]: Extracted representations of the figures
+        Any: What `func` returned, or None if it couldn't be pickled
+
+    Raises:
+        CaptureTimeout: If `func` didn't finish within `timeout` seconds
+        CaptureError: If `func` raised an exception, ran out of memory,
+            or its process died
+    """
+    if memory_limit is not None and resource is None:
+        raise ValueError("memory_limit isn't supported on this platform")
+    context = multiprocessing.get_context()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_capture_in_sandbox, daemon=True,
+                              args=(sender, func, args, kwargs or {}, memory_limit,
+                                    render))
+    process.start()
+    sender.close()
+    name = getattr(func, "__name__", repr(func))
+    try:
+        if not receiver.poll(timeout):
+            raise CaptureTimeout(f"{name} didn't finish within {timeout} seconds")
+        try:
+            result = receiver.recv()
+        except EOFError:
+            process.join()
+            raise CaptureError(f"The process running {name} died "
+                               f"(exit code {process.exitcode})") from None
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+
+    if result[0] == "error":
+        raise CaptureError(result[1])
+    _, figs, returns = result
+    return figs, returns
+
+def _capture_in_sandbox(conn, func, args, kwargs, memory_limit, render):
+    """Run by the process started by capture_figures_sandboxed"""
+    try:
+        if memory_limit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        plt.switch_backend("Agg")
+        with nullcontext() if render else no_render():
+            figs, returns = capture_figure_data(func, *args, **kwargs)
+        try:
+            conn.send(("ok", figs, returns))
+        except Exception:
+            # what the function returned couldn't be pickled
+            conn.send(("ok", figs, None))
+    except CaptureError as err:
+        conn.send(("error", str(err)))
+    except BaseException as err:
+        conn.send(("error", f"{type(err).__name__}: {err}"))
+    finally:
+        conn.close()
 
 def get_active_figures():
     """
@@ -90,11 +613,558 @@ def get_active_figures():
         figs.append(fig_manager.canvas.figure)
     return tuple(figs)
 
+class FigureProfile:
+    """
+    Wall time, call counts and array sizes recorded by `profile_figures`,
+    for each phase of grading ("capture", "extract", "sort" and "compare")
+    and each type of object ("figure", "axis", "line", "path_collection",
+    "patch" and "text"). The time of a phase excludes the time of any
+    phase nested inside it, e.g. reading tick labels lazily while comparing.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, phase, kind, seconds, calls=1, size=0):
+        """Add a measurement, and pass it on to the callback"""
+        with self._lock:
+            stat = self.stats.setdefault((phase, kind), [0, 0.0, 0])
+            stat[0] += calls
+            stat[1] += seconds
+            stat[2] += size
+        if self.callback is not None:
+            self.callback(phase, kind, seconds, calls, size)
+
+    def as_dict(self):
+        """
+        Returns:
+            Dict[str, Dict[str, dict]]: {phase: {kind: {"calls": int,
+            "seconds": float, "elements": int}}}, where elements is the
+            total size of the arrays involved
+        """
+        stats = {}
+        for (phase, kind), (calls, seconds, size) in self.stats.items():
+            stats.setdefault(phase, {})[kind] = {"calls": calls, "seconds": seconds,
+                                                 "elements": size}
+        return stats
+
+    def report(self):
+        """Return a table of the measurements, slowest first"""
+        rows = [f"{'phase':<10}{'kind':<17}{'calls':>9}{'seconds':>12}{'elements':>13}"]
+        for (phase, kind), (calls, seconds, size) in sorted(
+                self.stats.items(), key=lambda item: -item[1][1]):
+            rows.append(f"{phase:<10}{kind:<17}{calls:>9}{seconds:>12.6f}{size:>13}")
+        return "\n".join(rows)
+
+_profile = None
+
+@contextmanager
+def profile_figures(callback=None):
+    """
+    Record how long each phase of capturing, extracting and comparing
+    figures takes, while the context is active.
+
+        with profile_figures() as profile:
+            assert_similar_figures(ref_fig, fig)
+        print(profile.report())
+
+    Parameters:
+        callback (callable): If given, called with (phase, kind, seconds,
+            calls, size) for each measurement as it is made
+
+    Yields:
+        FigureProfile: The measurements
+    """
+    global _profile
+    previous = _profile
+    _profile = FigureProfile(callback)
+    try:
+        yield _profile
+    finally:
+        _profile = previous
+
+class _Timer:
+    """Times a phase for a FigureProfile"""
+    def __init__(self, profile, phase, kind, calls, size):
+        self.profile = profile
+        self.phase = phase
+        self.kind = kind
+        self.calls = calls
+        self.size = size
+        self.nested = 0.0
+
+    def add(self, calls=0, size=0):
+        self.calls += calls
+        self.size += size
+
+    def __enter__(self):
+        stack = self.profile._local.__dict__.setdefault("stack", [])
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        elapsed = time.perf_counter() - self.start
+        stack = self.profile._local.stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.profile.record(self.phase, self.kind, elapsed - self.nested,
+                            self.calls, self.size)
+        return False
+
+class _NoTimer:
+    """Stands in for _Timer when nothing is being profiled"""
+    def __bool__(self):
+        return False
+
+    def add(self, calls=0, size=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def _timed(phase, kind, calls=1, size=0):
+    """
+    Context manager timing a phase, if profiling is on. Calls and sizes which
+    are expensive to work out should only be added if the timer is truthy.
+    """
+    if _profile is None:
+        return _NO_TIMER
+    return _Timer(_profile, phase, kind, calls, size)
+
+def _data_size(item):
+    """The number of data points in a line or path collection"""
+    return np.size(item.x_data) + np.size(item.y_data)
+
+GradeResult = namedtuple("GradeResult",
+                         ("submission", "passed", "error", "message", "digest"),
+                         defaults=(None,))
+GradeResult.__doc__ = """
+The result of grading one submission with `grade_batch`
+
+Attributes:
+    submission (int): The index of the submission
+    passed (bool): Whether the submission's figures are similar to the reference
+    error (bool): True if the submission raised an exception, so couldn't be graded
+    message (str): Why the submission failed, or None if it passed
+    digest (str): With `grade_batch(..., fingerprint=True)`, the digest of the
+        content of the submission's figures, so identical submissions can be
+        found. Otherwise None.
+"""
+
+def grade_batch(reference, submissions, attrs=None, tol=1e-5, workers=None,
+                ordered_scatter=True, timeout=None, memory_limit=None,
+                fingerprint=False, store=None, threads=False, render=False):
+    """
+    Grade many submissions against one reference, in a pool of processes.
+
+    The reference is built once and sent to each worker process when it
+    starts. Each worker then runs `capture_figure_data` on a submission, in
+    `no_render` so that showing or saving figures costs nothing (unless
+    `render`), and compares the figures it made to the reference.
+
+    Parameters:
+        reference: The reference figure (a matplotlib figure or `Figure`), or
+            a sequence of them if each submission should make several figures
+        submissions (Iterable): The submissions. Each is a function which makes
+            the figures, or a tuple (func, args) or (func, args, kwargs) to call
+            it with arguments. The functions must be picklable, e.g. defined at
+            the top level of a module.
+        attrs, tol, ordered_scatter: As for `assert_similar_figures`
+        workers (int): The number of processes to use. Defaults to the number
+            of CPUs. If 1, the submissions are graded in this process.
+        timeout, memory_limit: If either is given, each submission is run
+            with `capture_figures_sandboxed`, which stops it if it runs for
+            longer than `timeout` seconds or uses more than `memory_limit`
+            bytes. The submission then fails with `error` set.
+        fingerprint (bool): If True, work out the digest of each submission's
+            figures. Submissions identical to the reference then pass without
+            being compared, and the digests are returned in the results.
+        store (ResultStore): If given, results already in the store are
+            returned without grading the submission again, and the figures
+            each submission makes are kept, so a submission is only run again
+            once its source changes. New results are added to the store.
+        threads (bool): If True, grade in a pool of `workers` threads in this
+            process instead, which starts much faster than a pool of
+            processes. Each submission makes its figures in
+            `isolated_figures`, and pyplot should be using a non-interactive
+            backend (e.g. "Agg"). Submissions are only isolated from each other
+            through pyplot's figures, so they mustn't change other global
+            state, including interactive mode and `rcParams`.
+        render (bool): If False, saving a figure with `savefig` writes no
+            file, so a submission which reads the file it saved fails with
+            `error` set. Pass True to grade such submissions, which then pay
+            for drawing their figures.
+
+    Returns:
+        List[GradeResult]: The result for each submission, in order
+    """
+    if isinstance(reference, (list, tuple)):
+        references = reference
+    else:
+        references = (reference,)
+    references = tuple(ref if isinstance(ref, Figure) else Figure(ref)
+                       for ref in references)
+    for ref in references:
+        ref.extract()
+        if fingerprint:
+            ref.digest
+    grading = (references, attrs, tol, ordered_scatter, timeout, memory_limit,
+               fingerprint, render)
+    submissions = list(submissions)
+
+    if store is None:
+        return _map_grading(_grade_submission, _grade_in_worker, grading, workers,
+                            threads, range(len(submissions)), submissions)
+
+    reference_digest = _digest([ref.digest for ref in references])
+    results = [None] * len(submissions)
+    todo = []
+    for i, submission in enumerate(submissions):
+        capture_key = _digest(submission_hash(submission), timeout, memory_limit,
+                              render, matplotlib.__version__,
+                              REFERENCE_FORMAT_VERSION)
+        result_key = _digest(capture_key, reference_digest, attrs, tol,
+                             ordered_scatter, fingerprint)
+        result = store.get_result(result_key)
+        if result is not None:
+            results[i] = result._replace(submission=i)
+        else:
+            todo.append((i, submission, capture_key, result_key,
+                         store.get_capture(capture_key)))
+
+    graded = _map_grading(_grade_captured, _grade_captured_in_worker, grading,
+                          workers, threads, *zip(*[(i, submission, captured)
+                                          for i, submission, _, _, captured in todo]))
+    for (i, _, capture_key, result_key, _), (result, new_captured) in \
+            zip(todo, graded):
+        if new_captured is not None:
+            store.put_capture(capture_key, new_captured)
+        store.put_result(result_key, result)
+        results[i] = result
+    return results
+
+def _map_grading(function, worker_function, grading, workers, threads, *iterables):
+    """
+    Call `function(*args, grading)` for each set of arguments, either in this
+    process, in a pool of threads, or through `worker_function(*args)` in a
+    pool of processes.
+    """
+    if not iterables or not iterables[0]:
+        return []
+    if workers == 1:
+        return [function(*args, grading) for args in zip(*iterables)]
+    if threads:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda *args: function(*args, grading),
+                                     *iterables))
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_grading_worker,
+                             initargs=(grading,)) as executor:
+        return list(executor.map(worker_function, *iterables))
+
+_worker_grading = None
+
+def _init_grading_worker(grading):
+    """Keep the reference for the submissions graded by this worker process"""
+    global _worker_grading
+    _worker_grading = grading
+    # worker processes have nowhere to show figures
+    plt.switch_backend("Agg")
+
+def _grade_in_worker(i, submission):
+    return _grade_submission(i, submission, _worker_grading)
+
+def _grade_captured_in_worker(i, submission, captured):
+    return _grade_captured(i, submission, captured, _worker_grading)
+
+def _split_submission(submission):
+    """Split a submission into the function, its args and its kwargs"""
+    if callable(submission):
+        submission = (submission,)
+    func, args, kwargs = submission[0], (), {}
+    if len(submission) > 1:
+        args = submission[1]
+    if len(submission) > 2:
+        kwargs = submission[2]
+    return func, args, kwargs
+
+def _capture_submission(submission, grading):
+    """Capture the figures made by a submission, raising `CaptureError` if it fails"""
+    func, args, kwargs = _split_submission(submission)
+    timeout, memory_limit, render = grading[4], grading[5], grading[7]
+    if timeout is None and memory_limit is None:
+        with nullcontext() if render else no_render():
+            figs, _ = capture_figure_data(func, *args, **kwargs)
+    else:
+        figs, _ = capture_figures_sandboxed(func, args, kwargs, timeout=timeout,
+                                            memory_limit=memory_limit,
+                                            render=render)
+    return [fig if isinstance(fig, Figure) else Figure(fig) for fig in figs]
+
+def _grade_submission(i, submission, grading):
+    """Capture the figures made by a submission and compare them to the reference"""
+    try:
+        figs = _capture_submission(submission, grading)
+    except CaptureError as err:
+        return GradeResult(i, False, True, str(err))
+    return _compare_submission(i, figs, grading)
+
+def _grade_captured(i, submission, captured, grading):
+    """
+    Like `_grade_submission`, but for a submission which may already have been
+    captured. `captured` is a (figures, error) pair, where figures are the
+    bytes of a binary reference file of the figures the submission made and
+    error the message if it failed, or None if the submission hasn't been
+    captured yet. If the figures kept can't be read, the submission is
+    captured again.
+
+    Returns:
+        Tuple[GradeResult, tuple]: The result, and the new (figures, error)
+        pair to keep, or None if there's nothing new to keep
+    """
+    figs = None
+    if captured is not None and captured[1] is None:
+        try:
+            figs = _figures_from_bytes(captured[0])
+        except (ValueError, KeyError, OSError, zipfile.BadZipFile):
+            # e.g. kept by an earlier version which wrote unreadable files
+            captured = None
+    new_captured = None
+    if captured is None:
+        try:
+            figs = _capture_submission(submission, grading)
+        except CaptureError as err:
+            captured = new_captured = (None, str(err))
+        else:
+            try:
+                new_captured = (_figures_to_bytes(figs), None)
+            except ValueError:
+                # the figures can't be kept, but can still be graded
+                pass
+    if figs is None:
+        return GradeResult(i, False, True, captured[1]), new_captured
+    return _compare_submission(i, figs, grading), new_captured
+
+def _compare_submission(i, figs, grading):
+    """Compare the figures made by a submission to the reference"""
+    references, attrs, tol, ordered_scatter, _, _, fingerprint, _ = grading
+    if len(figs) != len(references):
+        msg = (f"Incorrect number of figures. Expected {len(references)}, "
+               f"found {len(figs)}")
+        return GradeResult(i, False, False, msg)
+    digest = _digest([fig.digest for fig in figs]) if fingerprint else None
+    try:
+        for ref, fig in zip(references, figs):
+            ref.assert_similar(fig, attrs, tol=tol,
+                               ordered_scatter=ordered_scatter)
+    except AssertionError as err:
+        return GradeResult(i, False, False, str(err), digest)
+    return GradeResult(i, True, False, None, digest)
+
+def _figures_to_bytes(figs):
+    """The bytes of a binary reference file holding `figs`"""
+    buffer = io.BytesIO()
+    save_figures(buffer, [(str(i), fig) for i, fig in enumerate(figs)])
+    return buffer.getvalue()
+
+def _figures_from_bytes(data):
+    """Read figures written by `_figures_to_bytes`"""
+    figs = load_figures(io.BytesIO(data))
+    return [figs[str(i)] for i in range(len(figs))]
+
+def submission_hash(submission):
+    """
+    Hash of the source of a submission, and the arguments it is called with.
+    Arrays, numbers, strings and lists, tuples and dicts of them are hashed
+    exactly, functions by their name and source, and other arguments by
+    their repr.
+
+    The whole source file the submission's function is defined in is hashed,
+    so changing a helper function in the same file changes the hash. Changes
+    to other modules it imports don't.
+
+    Parameters:
+        submission: A function, or a tuple (func, args) or (func, args, kwargs)
+            as for `grade_batch`
+
+    Returns:
+        str: The hex digest
+
+    Raises:
+        TypeError: If the source of the function can't be found, or an
+            argument's repr holds its memory address, which changes from run
+            to run, so the hash would never be the same twice
+    """
+    func, args, kwargs = _split_submission(submission)
+    try:
+        with open(inspect.getsourcefile(func), "rb") as f:
+            source = f.read()
+    except (TypeError, OSError):
+        # e.g. defined interactively, so fall back to the compiled code
+        code = getattr(func, "__code__", None)
+        if code is None:
+            raise TypeError(f"Can't find the source of {func!r}") from None
+        source = _digest(_code_key(code)).encode()
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', '')}"
+    # arrays are hashed exactly, as their repr leaves out most of a large array
+    return _digest(hashlib.sha256(source).hexdigest(), name,
+                   _argument_key(list(args)), _argument_key(sorted(kwargs.items())))
+
+# e.g. "<function f at 0x7f...>" or "<object object at 0x7f...>"
+_ADDRESS = re.compile(r"\bat 0x[0-9a-fA-F]+")
+
+def _argument_key(value):
+    """
+    An argument of a submission as a value `_digest` hashes the same way in
+    every run: functions are replaced by their name and source.
+
+    Raises:
+        TypeError: If the repr of the argument holds its memory address
+    """
+    if value is None or isinstance(value, (str, bytes, numbers.Number,
+                                           np.ndarray, np.generic)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_argument_key(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _argument_key(item) for key, item in value.items()}
+    if inspect.ismethod(value):
+        return ["method", _argument_key(value.__func__),
+                _argument_key(value.__self__)]
+    if isinstance(value, partial):
+        return ["partial", _argument_key(value.func), _argument_key(value.args),
+                _argument_key(value.keywords)]
+    if callable(value) and hasattr(value, "__qualname__"):
+        try:
+            source = inspect.getsource(value)
+        except (TypeError, OSError):
+            source = None
+        code = getattr(value, "__code__", None)
+        return ["callable", getattr(value, "__module__", None), value.__qualname__,
+                source, None if code is None else _code_key(code)]
+    text = repr(value)
+    if _ADDRESS.search(text):
+        raise TypeError(f"Can't hash the argument {text}, as its repr changes "
+                        f"from run to run")
+    return value
+
+def _code_key(code):
+    """The compiled code of a function, as values which are the same in every run"""
+    consts = []
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            consts.append(_code_key(const))
+        elif isinstance(const, frozenset):
+            # the order of a set of strings changes from run to run
+            consts.append(sorted(map(repr, const)))
+        else:
+            consts.append(repr(const))
+    return [code.co_code, consts, list(code.co_names)]
+
+class ResultStore:
+    """
+    SQLite file of grading results, used by `grade_batch(..., store=store)`.
+
+    Two things are kept: the figures each submission made, keyed by the hash
+    of its source and arguments, and the result of grading them, keyed also
+    by the digest of the reference, `attrs` and `tol`. Grading again after a
+    change to the reference then only compares the figures kept, and a
+    submission is only run again once its source changes.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path (str): The database file, which is created if it doesn't exist
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS captures "
+                "(key TEXT PRIMARY KEY, figures BLOB, error TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, passed INTEGER, error INTEGER, "
+                "message TEXT, digest TEXT)")
+
+    def get_capture(self, key):
+        """The (figures, error) pair kept for a submission, or None"""
+        return self._connection.execute(
+            "SELECT figures, error FROM captures WHERE key = ?", (key,)).fetchone()
+
+    def put_capture(self, key, captured):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO captures VALUES (?, ?, ?)", (key, *captured))
+
+    def get_result(self, key):
+        """The `GradeResult` kept for a key, with `submission` None, or None"""
+        row = self._connection.execute(
+            "SELECT passed, error, message, digest FROM results WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        passed, error, message, digest = row
+        return GradeResult(None, bool(passed), bool(error), message, digest)
+
+    def put_result(self, key, result):
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, result.passed, result.error, result.message, result.digest))
+
+    def clear(self):
+        """Forget every result and captured figure"""
+        with self._connection:
+            self._connection.execute("DELETE FROM captures")
+            self._connection.execute("DELETE FROM results")
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
 class FigureOutput:
-    """ Handles writing figures to a file """
-    def __init__(self, file_name):
+    """
+    Handles writing figures to a file
+
+    If `file_name` ends in ".npz" the figures are written in the binary
+    reference format (see `save_figures`), otherwise they are written as
+    python source.
+    """
+    def __init__(self, file_name, envelope_block=None, envelope_only=False):
+        """
+        Parameters:
+            file_name (str): The file to write to
+            envelope_block (int): If given, long lines are written with a
+                `LineEnvelope` with blocks of this many points, which other
+                lines are compared to (see `Figure.build_envelopes`). Only
+                for ".npz" files.
+            envelope_only (bool): If True, only the envelopes of long lines
+                are written, not their data
+        """
         self.figs = []
         self.file_name = file_name
+        self.envelope_block = envelope_block
+        self.envelope_only = envelope_only
+        if envelope_block is not None and not file_name.endswith(".npz"):
+            raise ValueError("Envelopes can only be written to .npz files")
 
     def write_to_file(self, fig, fig_name):
         self.figs.append((fig, fig_name))
@@ -103,7 +1173,16 @@ class FigureOutput:
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        with open(self.file_name, "w", encoding="utf-8") as f:
+        if self.file_name.endswith(".npz"):
+            figs = [(fig_name, fig) for fig, fig_name in self.figs]
+            if self.envelope_block is not None:
+                figs = [(fig_name, _copy_figure(fig).build_envelopes(
+                            self.envelope_block, keep_data=not self.envelope_only))
+                        for fig_name, fig in figs]
+            save_figures(self.file_name, figs)
+            return
+        with open(self.file_name, "w", encoding="utf-8") as f, \
+                np.printoptions(threshold=sys.maxsize):
             f.write("from autograder.matplotlib_figure_testing.test_figures import *\n")
             f.write("from matplotlib.text import Text\n")
             f.write("from matplotlib.path import Path\n")
@@ -115,43 +1194,586 @@ class FigureOutput:
                 f.write(f"{fig_name} = {Figure(fig)}")
                 f.write("\n")
 
+class StreamingFigureOutput:
+    """
+    Writes each figure to its own binary reference file in a directory as
+    soon as it is added, rather than keeping them all until the end.
+
+    Each figure is extracted, written to "<directory>/<fig_name>.npz" and
+    the matplotlib figure closed, so only one figure is held in memory at
+    a time, and the figures written before a crash are kept. Files are
+    written to a temporary file first and then renamed, so a file is never
+    left half written. The directory can be read with `load_figures`.
+    """
+    def __init__(self, directory, resume=True):
+        """
+        Parameters:
+            directory (str): The directory to write to, which is created if
+                it doesn't exist
+            resume (bool): If True, figures already in the directory are
+                kept, so an interrupted run can carry on where it stopped,
+                skipping the figures `in` the output. Otherwise they are
+                deleted.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if not resume:
+            for fig_name in self.fig_names():
+                os.remove(self._path(fig_name))
+
+    def write_to_file(self, fig, fig_name):
+        """Write a figure now, closing it if it is a matplotlib figure"""
+        if os.sep in fig_name or (os.altsep and os.altsep in fig_name):
+            raise ValueError(f"Invalid figure name {fig_name!r}")
+        path = self._path(fig_name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            save_figures(tmp_path, [(fig_name, fig)])
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if not isinstance(fig, Figure):
+            plt.close(fig)
+            fig.clear()
+
+    def fig_names(self):
+        """The names of the figures written to the directory, in order"""
+        return sorted(file_name[:-len(".npz")] for file_name in os.listdir(self.directory)
+                      if file_name.endswith(".npz"))
+
+    def _path(self, fig_name):
+        return os.path.join(self.directory, f"{fig_name}.npz")
+
+    def __contains__(self, fig_name):
+        return os.path.exists(self._path(fig_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+REFERENCE_FORMAT_VERSION = 1
+
+COLUMNAR_TABLES = ("figures", "axes", "texts", "lines", "path_collections", "patches")
+
+def export_columnar(figures, directory):
+    """
+    Write the figures of many submissions to a directory of column files,
+    so that they can be analysed across the whole cohort with numpy.
+
+    Each table is written to "<directory>/<table>.npz", holding one array
+    per column and one row per item: "figures", "axes", "texts" (tick labels
+    and legend entries), "lines", "path_collections" and "patches". Every
+    row has the `submission` it came from and the index of its `figure`
+    (and `axis`, if it is in one). The points of the lines and of the
+    scatter plots are concatenated in the "x_data" and "y_data" columns of
+    their table, and the points of row i are `x_data[offsets[i]:offsets[i + 1]]`.
+    Read the tables with `load_columnar`.
+
+    Values missing from older reference files are written as -1, or NaN
+    for sizes and "" for text.
+
+    Parameters:
+        figures: A dictionary of the figures of each submission, keyed by
+            the name of the submission, or an iterable of (name, figures)
+            pairs. The figures of a submission are a `Figure` (or matplotlib
+            figure) or a sequence of them.
+        directory (str): The directory to write to
+    """
+    if isinstance(figures, dict):
+        figures = figures.items()
+    tables = {table: {} for table in COLUMNAR_TABLES}
+    points = {"lines": ([], []), "path_collections": ([], [])}
+
+    def add(table, **row):
+        for column, value in row.items():
+            tables[table].setdefault(column, []).append(value)
+
+    def known(value, missing=-1):
+        # older reference files don't have every attribute
+        return missing if value is None else value
+
+    for submission, figs in figures:
+        if not isinstance(figs, (list, tuple)):
+            figs = (figs,)
+        submission = str(submission)
+        for i, fig in enumerate(figs):
+            if not isinstance(fig, Figure):
+                fig = Figure(fig)
+            width, height = known(fig.size, (np.nan, np.nan))
+            add("figures", submission=submission, figure=i, width=width,
+                height=height, suptitle=known(fig.suptitle, ""),
+                has_suptitle=known(fig.has_suptitle), num_axes=len(fig.axes))
+            for j, axis in enumerate(fig.axes):
+                rows, columns = known(axis.grid_spec, (-1, -1))
+                add("axes", submission=submission, figure=i, axis=j,
+                    title=known(axis.title, ""), has_title=known(axis.has_title),
+                    xlabel=known(axis.xlabel, ""), ylabel=known(axis.ylabel, ""),
+                    x_scale=known(axis.x_scale, ""), y_scale=known(axis.y_scale, ""),
+                    has_legend=known(axis.has_legend),
+                    num_legend_entries=known(axis.num_legend_entries),
+                    grid_rows=rows, grid_columns=columns,
+                    sharex=known(axis.sharex), sharey=known(axis.sharey),
+                    num_lines=len(axis.lines),
+                    num_path_collections=len(axis.path_collections),
+                    num_patches=len(axis.patches))
+                for attr in ("xtick_label", "ytick_label", "legend_entries"):
+                    for k, text in enumerate(getattr(axis, attr)):
+                        if text is not None:
+                            add("texts", submission=submission, figure=i, axis=j,
+                                attr=attr, index=k, x=text.x, y=text.y,
+                                text=text.text, size=text.size)
+                for k, line in enumerate(axis.lines):
+                    add("lines", submission=submission, figure=i, axis=j, line=k,
+                        colour=line.colour, label=line.label,
+                        linestyle=line.linestyle, marker=str(line.marker),
+                        linewidth=line.linewidth)
+                    _add_points(points["lines"], line.x_data, line.y_data)
+                for k, pc in enumerate(axis.path_collections):
+                    add("path_collections", submission=submission, figure=i,
+                        axis=j, collection=k)
+                    _add_points(points["path_collections"], pc.x_data, pc.y_data)
+                patch_types = [patch_type.patch_type
+                               for patch_type in PatchArray.patch_types]
+                patches = axis.patches
+                for k in range(len(patches)):
+                    add("patches", submission=submission, figure=i, axis=j,
+                        kind=patch_types[patches.kind[k]],
+                        **{column: float(getattr(patches, column)[k])
+                           for column in PatchArray.columns})
+
+    os.makedirs(directory, exist_ok=True)
+    for table, columns in tables.items():
+        arrays = {column: np.array(values) for column, values in columns.items()}
+        if table in points:
+            x_data, y_data = points[table]
+            arrays["offsets"] = np.concatenate(
+                ([0], np.cumsum([x.size for x in x_data], dtype=np.int64)))
+            arrays["x_data"] = np.concatenate(x_data) if x_data else np.empty(0)
+            arrays["y_data"] = np.concatenate(y_data) if y_data else np.empty(0)
+        # load_columnar can't read pickled object arrays
+        arrays = {column: _storable_array(array) for column, array in arrays.items()}
+        np.savez(os.path.join(directory, f"{table}.npz"), **arrays)
+
+def _add_points(points, x_data, y_data):
+    """Add the data of a line or scatter plot, as floats, to the lists of points"""
+    size = max(np.size(x_data), np.size(y_data)) if x_data is not None else 0
+    for values, data in zip(points, (x_data, y_data)):
+        try:
+            data = np.asarray(data, dtype=float).ravel()
+        except (TypeError, ValueError):
+            # e.g. dates or categories
+            data = np.full(size, np.nan)
+        if data.size != size:
+            data = np.full(size, np.nan)
+        values.append(data)
+
+def load_columnar(directory, mmap=False):
+    """
+    Read the tables written by `export_columnar`
+
+    Parameters:
+        directory (str): The directory written to
+        mmap (bool): If True, the columns are memory maps of the files (see
+            `load_figures`)
+
+    Returns:
+        Dict[str, Dict[str, numpy.ndarray]]: The columns of each table
+    """
+    tables = {}
+    for table in COLUMNAR_TABLES:
+        file_name = os.path.join(directory, f"{table}.npz")
+        if mmap:
+            tables[table] = _mmap_npz(file_name)
+        else:
+            with np.load(file_name, allow_pickle=False) as data:
+                tables[table] = dict(data)
+    return tables
+
+def _copy_figure(fig):
+    """A copy of a figure (sharing its arrays) which can be changed"""
+    if not isinstance(fig, Figure):
+        return Figure(fig).extract()
+    arrays = {}
+    return Figure._unpack(fig._pack(arrays), arrays)
+
+def save_figures(file_name, figs):
+    """
+    Write figures to a binary reference file.
+
+    The file is an uncompressed numpy ".npz" archive. Every array is stored
+    exactly, as its own member, and the rest of the figure is stored as a
+    small json header in the "__meta__" member.
+
+    Parameters:
+        file_name (str): The file to write to, or a binary file object
+        figs (Iterable[Tuple[str, Figure]]): (name, figure) pairs. The figures
+            can be matplotlib figures or `Figure` objects
+    """
+    if isinstance(figs, dict):
+        figs = figs.items()
+    arrays = {}
+    meta = {"version": REFERENCE_FORMAT_VERSION, "figures": {}}
+    for fig_name, fig in figs:
+        if not isinstance(fig, Figure):
+            fig = Figure(fig)
+        meta["figures"][fig_name] = fig._pack(arrays)
+    arrays["__meta__"] = np.frombuffer(json.dumps(meta).encode("utf-8"),
+                                       dtype=np.uint8)
+    if hasattr(file_name, "write"):
+        np.savez(file_name, **arrays)
+        return
+    with open(file_name, "wb") as f:
+        np.savez(f, **arrays)
+
+def load_figures(file_name, mmap=False):
+    """
+    Read figures written by `save_figures`, or a directory of them written
+    by `StreamingFigureOutput`
+
+    Parameters:
+        file_name (str): The reference file or directory, or a binary file object
+        mmap (bool): If True, the arrays in the figures are read-only views
+            of a memory map of the file, rather than copies in memory. Several
+            processes loading the same file then share one copy of the data
+            through the OS page cache.
+
+    Returns:
+        Dict[str, Figure]: The figures, keyed by the name they were saved with
+    """
+    if isinstance(file_name, (str, os.PathLike)) and os.path.isdir(file_name):
+        figs = {}
+        for name in sorted(os.listdir(file_name)):
+            if name.endswith(".npz"):
+                figs.update(load_figures(os.path.join(file_name, name), mmap=mmap))
+        return figs
+    if mmap:
+        return _unpack_figures(_mmap_npz(file_name), file_name)
+    with np.load(file_name, allow_pickle=False) as data:
+        return _unpack_figures(data, file_name)
+
+class ReferenceCache:
+    """
+    Least recently used cache of the reference figures in files.
+
+    Files are keyed by their path, modification time and size, so a file is
+    only read and its figures built again once it has changed. The figures
+    returned are shared between callers, so shouldn't be modified.
+    """
+    def __init__(self, maxsize=32):
+        """
+        Parameters:
+            maxsize (int): The most files to keep the figures of
+        """
+        self.maxsize = maxsize
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, file_name, mmap=False):
+        """
+        Load the figures in a reference file, either a binary reference file
+        (see `load_figures`) or a python module, like those written by
+        `FigureOutput`, which defines the figures as global variables.
+
+        Returns:
+            Dict[str, Figure]: The figures, keyed by name
+        """
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, mmap)
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+                return self._files[key]
+
+        figs = _load_reference_file(path, mmap)
+        with self._lock:
+            # forget older versions of the file
+            for old_key in [k for k in self._files if k[0] == path]:
+                del self._files[old_key]
+            self._files[key] = figs
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+        return figs
+
+    def clear(self):
+        """Forget every file"""
+        with self._lock:
+            self._files.clear()
+
+    def __len__(self):
+        return len(self._files)
+
+reference_cache = ReferenceCache()
+
+def load_reference(file_name, mmap=False):
+    """
+    Load the figures in a reference file through `reference_cache`, so
+    that loading the same file again returns the figures already built.
+    See `ReferenceCache.load`.
+    """
+    return reference_cache.load(file_name, mmap=mmap)
+
+def _load_reference_file(path, mmap=False):
+    """Read the figures in a binary or python reference file, or a directory"""
+    if path.endswith(".npz") or os.path.isdir(path):
+        return load_figures(path, mmap=mmap)
+    module_name = f"_reference_{abs(hash(path))}"
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {name: value for name, value in vars(module).items()
+            if isinstance(value, Figure)}
+
+def _unpack_figures(arrays, file_name):
+    """Build the figures in a reference file from its arrays"""
+    meta = json.loads(arrays["__meta__"].tobytes().decode("utf-8"))
+    if meta.get("version") != REFERENCE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported reference format version "
+                         f"{meta.get('version')} in {file_name}")
+    return {fig_name: Figure._unpack(fig_meta, arrays)
+            for fig_name, fig_meta in meta["figures"].items()}
+
+def _mmap_npz(file_name):
+    """
+    Memory map every member of an uncompressed ".npz" file. The file is
+    mapped once, and each member is a view of it, so a file of many arrays
+    doesn't use a file descriptor for each.
+
+    Returns:
+        Dict[str, numpy.ndarray]: read-only arrays backed by the file
+    """
+    arrays = {}
+    with zipfile.ZipFile(file_name) as archive, open(file_name, "rb") as f:
+        mapped = np.memmap(f, dtype=np.uint8, mode="r")
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Can't memory map compressed member "
+                                 f"{info.filename} of {file_name}")
+            # the local file header is 30 bytes, followed by the file name
+            # and an extra field, whose lengths are at the end of the header
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack("<HH", f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"Can't memory map object array "
+                                 f"{info.filename} of {file_name}")
+            if math.prod(shape) == 0:
+                # mmap can't map zero bytes
+                array = np.empty(shape, dtype=dtype)
+            else:
+                array = np.ndarray(shape, dtype=dtype, buffer=mapped,
+                                   offset=f.tell(),
+                                   order="F" if fortran_order else "C")
+            arrays[info.filename[:-len(".npy")]] = array
+    return arrays
+
 class Figure:
     """Representation of a matplotlib figure object"""
     all_attrs = ("suptitle", "has_suptitle", "sup_ylabel", "sup_xlabel", "size")
     def __init__(self, fig):
+        """
+        Parameters:
+            fig: A matplotlib figure, or a dictionary of the properties of
+                the figure. A matplotlib figure is read lazily, so changes
+                made to it before a property is first used are seen. Call
+                `extract` to take a snapshot of the figure.
+        """
         if isinstance(fig, dict):
             self.size = fig.get("size")
             self.suptitle = fig.get("suptitle")
-            self.sup_xlabel = fig.get("sup_xlabel", None)
-            self.sup_ylabel = fig.get("sup_ylabel", None)
+            self.sup_xlabel = TextValue.from_text(fig.get("sup_xlabel", None))
+            self.sup_ylabel = TextValue.from_text(fig.get("sup_ylabel", None))
             self.has_suptitle = fig.get("has_suptitle", False)
             self.axes = [axis for axis in fig["axes"]]
         else:
-            self.size = fig.get_figwidth(), fig.get_figheight()
-            sup_title = fig._suptitle
-            self.sup_xlabel = fig._supxlabel
-            self.sup_ylabel = fig._supylabel
-            if sup_title:
-                self.suptitle = fig._suptitle.get_text()
-                self.has_suptitle = True
-            else:
-                self.suptitle = ""
-                self.has_suptitle = False
-            self.axes = [Axis(axis) for axis in fig.get_axes()]
+            # the properties are read from the matplotlib figure the
+            # first time they are used, like the properties of Axis
+            self._fig = fig
+
+    _lazy_attrs = all_attrs + ("axes",)
+
+    @cached_property
+    def size(self):
+        return self._fig.get_figwidth(), self._fig.get_figheight()
+
+    @cached_property
+    def suptitle(self):
+        if self._fig._suptitle:
+            return self._fig._suptitle.get_text()
+        return ""
+
+    @cached_property
+    def has_suptitle(self):
+        return True if self._fig._suptitle else False
+
+    @cached_property
+    def sup_xlabel(self):
+        return TextValue.from_text(self._fig._supxlabel)
+
+    @cached_property
+    def sup_ylabel(self):
+        return TextValue.from_text(self._fig._supylabel)
+
+    @cached_property
+    def axes(self):
+        axes = self._fig.get_axes()
+        with _timed("extract", "axis", calls=len(axes)):
+            return [Axis(axis) for axis in axes]
+
+    def extract(self):
+        """
+        Read every property from the matplotlib figure and its axes now,
+        and drop the references to them. Returns the figure.
+        """
+        for attr in self._lazy_attrs:
+            getattr(self, attr)
+        for axis in self.axes:
+            axis.extract()
+        self.__dict__.pop("_fig", None)
+        return self
+
+    def build_envelopes(self, block=1024, fanout=16, keep_data=True):
+        """
+        Build a `LineEnvelope` for each line with more than `block` points,
+        so that other figures are compared to these lines coarse to fine,
+        rather than point by point. See `Line.build_envelopes` for the
+        parameters. Returns the figure.
+        """
+        for axis in self.axes:
+            for line in axis.lines:
+                if max(np.size(line.x_data), np.size(line.y_data)) > block:
+                    line.build_envelopes(block, fanout, keep_data=keep_data)
+        return self
+
+    @classmethod
+    def load(cls, file_name, fig_name=None, mmap=False):
+        """
+        Load a figure from a binary reference file written by `save_figures`.
+        `fig_name` may be omitted if the file only holds one figure. See
+        `load_figures` for `mmap`.
+        """
+        figs = load_figures(file_name, mmap=mmap)
+        if fig_name is None:
+            if len(figs) != 1:
+                raise ValueError(f"{file_name} holds {len(figs)} figures, "
+                                 "so a fig_name must be given")
+            return next(iter(figs.values()))
+        return figs[fig_name]
+
+    def _pack(self, arrays):
+        """Return the json-able header for the figure, storing arrays in `arrays`"""
+        return {
+            "size": [float(i) for i in self.size] if self.size else None,
+            "suptitle": self.suptitle,
+            "has_suptitle": self.has_suptitle,
+            "sup_xlabel": _pack_text(self.sup_xlabel),
+            "sup_ylabel": _pack_text(self.sup_ylabel),
+            "axes": [axis._pack(arrays) for axis in self.axes],
+        }
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build a figure from a header written by `_pack`"""
+        return cls({
+            "size": tuple(meta["size"]) if meta["size"] else None,
+            "suptitle": meta["suptitle"],
+            "has_suptitle": meta["has_suptitle"],
+            "sup_xlabel": _unpack_text(meta["sup_xlabel"]),
+            "sup_ylabel": _unpack_text(meta["sup_ylabel"]),
+            "axes": [Axis._unpack(axis, arrays) for axis in meta["axes"]],
+        })
 
     def get_num_axes(self):
         """Returns the number of axes in the figure"""
         return len(self.axes)
 
-    def assert_similar(self, other, attrs=None, tol=None):
+    @cached_property
+    def digest(self):
+        """
+        Hex digest of the content of the figure and everything in it.
+        Figures with the same digest are identical, so are similar for any
+        attrs and tol, unless their lines or scatter plots hold NaN, which
+        isn't close to anything, not even NaN (see `_has_nan_data`).
+        """
+        return _digest([getattr(self, attr) for attr in self.all_attrs],
+                       [axis.digest for axis in self.axes])
+
+    @cached_property
+    def _has_nan_data(self):
+        """
+        Whether a line or scatter plot holds NaN. Identical data holding NaN
+        isn't similar, as `first_difference` counts NaN as different to NaN,
+        so identical digests don't mean the figures are similar.
+        """
+        for axis in self.axes:
+            for item in axis.lines + axis.path_collections:
+                envelopes = getattr(item, "envelopes", None) or {}
+                if (_has_nan(item.x_data) or _has_nan(item.y_data)
+                        or any(_has_nan(level) for envelope in envelopes.values()
+                               for level in envelope.mins)):
+                    return True
+        return False
+
+    def assert_similar(self, other, attrs=None, tol=None, ordered_scatter=True,
+                       matching="optimal"):
         """Assert that the Figure is similar to another figure"""
+        self._diff(other, attrs, tol, ordered_scatter, matching,
+                   _DiffReport(first_only=True))
+
+    def diff(self, other, attrs=None, tol=None, ordered_scatter=True,
+             matching="optimal"):
+        """
+        Compare the figure to another figure, as `assert_similar` does, but
+        return every difference rather than raising the first.
+
+        Returns:
+            List[Difference]: The differences, which is empty if the figures
+            are similar
+        """
+        report = _DiffReport()
+        self._diff(other, attrs, tol, ordered_scatter, matching, report)
+        return report.differences
+
+    def _diff(self, other, attrs, tol, ordered_scatter, matching, report):
+        """Add the differences between the figures to `report`"""
+        # identical figures are similar, but only use the digests if they
+        # are already known, as working them out reads the whole figure.
+        # Measuring the errors needs every value, even if they're the same
+        if (not report.measure and "digest" in vars(self)
+                and "digest" in vars(other) and self.digest == other.digest
+                and not self._has_nan_data):
+            return
 
         test_attrs = self.all_attrs if not attrs else attrs
-        if self.get_num_axes() != other.get_num_axes():
-            raise AssertionError(f"Incorrect number of axes (subfigures). "
-                                 f"Expected {self.get_num_axes()}, "
-                                 f"found {other.get_num_axes()}")
-
+        same_num_axes = self.get_num_axes() == other.get_num_axes()
+        if not same_num_axes:
+            # the attributes of the axes and what they hold can't be compared
+            report.checked(set(test_attrs).difference(self.all_attrs), failed=1)
+            report.add((), "axes", self.get_num_axes(), other.get_num_axes(),
+                       f"Incorrect number of axes (subfigures). "
+                       f"Expected {self.get_num_axes()}, "
+                       f"found {other.get_num_axes()}",
+                       error=abs(self.get_num_axes() - other.get_num_axes()))
+
+        with _timed("compare", "figure"):
+            self._diff_attrs(other, test_attrs, tol, report)
+
+        if same_num_axes:
+            for i, (axis, other_axis) in enumerate(zip(self.axes, other.axes)):
+                axis._diff(other_axis, attrs, tol, ordered_scatter, matching,
+                           report, ("axes", i))
+
+    def _diff_attrs(self, other, test_attrs, tol, report):
+        """Add the differences in the attributes of the figure itself to `report`"""
+        report.checked(set(self.all_attrs).intersection(test_attrs))
         for attr in set(self.all_attrs).intersection(test_attrs):
             correct = True
             if attr in ("sup_xlabel", "sup_ylabel"):
@@ -164,12 +1786,12 @@ class Figure:
                 correct = False
 
             if not correct:
-                raise AssertionError(f"Incorrect {attr}. "
-                                     f"Expected {getattr(self, attr)}, "
-                                     f"found {getattr(other, attr)} \n")
-
-        for axis, other_axis in zip(self.axes, other.axes):
-            axis.assert_similar(other_axis, attrs, tol=tol)
+                report.add((), attr, getattr(self, attr), getattr(other, attr),
+                           f"Incorrect {attr}. "
+                           f"Expected {getattr(self, attr)}, "
+                           f"found {getattr(other, attr)} \n",
+                           error=lambda: _max_abs_error(getattr(self, attr),
+                                                        getattr(other, attr)))
 
     def __repr__(self):
         axis_repr = repr(list([axis for axis in self.axes]))
@@ -205,11 +1827,11 @@ class Axis:
             self.has_xlabel = ax.get("has_xlabel", False)
             self.ylabel = ax.get("ylabel")
             self.has_ylabel = ax.get("has_ylabel", False)
-            self.xtick_label = ax.get("xtick_label")
-            self.ytick_label = ax.get("ytick_label")
+            self.xtick_label = _as_text_list(ax.get("xtick_label"))
+            self.ytick_label = _as_text_list(ax.get("ytick_label"))
             self.x_scale = ax.get("x_scale")
             self.y_scale = ax.get("y_scale")
-            self.legend_entries = ax.get("legend_entries")
+            self.legend_entries = _as_text_list(ax.get("legend_entries"))
             self.num_legend_entries = ax.get("num_legend_entries")
             self.has_legend = ax.get("has_legend")
             self.grid_spec = ax.get("grid_spec")
@@ -218,46 +1840,177 @@ class Axis:
             # sort the lines, path_collections and patches, so that
             # the order that they get plotted in doesn't matter
             self.lines = sorted([line for line in ax.get("lines")])
-            self.path_collections = sorted([PathCollection(pc)
-                                     for pc in ax.get("path_collections", [])])
-            self.patches = sorted([patch for patch in ax.get("patches", [])])
+            self.path_collections = sorted([
+                pc if isinstance(pc, PathCollection) else PathCollection(pc)
+                for pc in ax.get("path_collections", [])])
+            self.patches = PatchArray(ax.get("patches", []))
         else:
-            # we need to create an axis from a matplotlib axis
-            self.title = ax.get_title()
-            self.has_title = False if self.title == "" else True
-            self.xlabel = ax.get_xaxis().get_label().get_text()
-            self.has_xlabel = False if self.xlabel == "" else True
-            self.ylabel = ax.get_yaxis().get_label().get_text()
-            self.has_ylabel = False if self.ylabel == "" else True
-            self.xtick_label = ax.get_xaxis().get_ticklabels()
-            self.ytick_label = ax.get_yaxis().get_ticklabels()
-            self.x_scale = ax.get_xscale()
-            self.y_scale = ax.get_yscale()
-            if ax._sharex:
-                self.sharex = ax.get_figure().get_axes().index(ax._sharex)
-            else:
-                self.sharex = None
-            if ax._sharey:
-                self.sharey = ax.get_figure().get_axes().index(ax._sharey)
-            else:
-                self.sharey = None
-            legend = ax.get_legend()
-            if legend:
-                self.legend_entries = [entry for entry in
-                                       ax.get_legend().get_texts()]
-                self.num_legend_entries = len(self.legend_entries)
-                self.has_legend = True
-            else:
-                self.legend_entries = [None]
-                self.num_legend_entries = 0
-                self.has_legend = False
-            self.grid_spec = ax.get_gridspec().get_geometry()
-            # sort the lines, path_collections and patches, so that
-            # the order that they get plotted in doesn't matter
-            self.lines = sorted([Line(line) for line in ax.get_lines() if line.get_xdata().size!=0])
-            self.path_collections = sorted([PathCollection(pc)
-                                     for pc in ax.collections])
-            self.patches = sorted([create_patch(patch) for patch in ax.patches])
+            # we need to create an axis from a matplotlib axis. Each property
+            # is read from it the first time it is used, so a comparison
+            # only pays for the properties it checks
+            self._ax = ax
+
+    _lazy_attrs = all_attrs + ("lines", "path_collections", "patches")
+
+    @cached_property
+    def title(self):
+        return self._ax.get_title()
+
+    @cached_property
+    def has_title(self):
+        return False if self.title == "" else True
+
+    @cached_property
+    def xlabel(self):
+        return self._ax.get_xaxis().get_label().get_text()
+
+    @cached_property
+    def has_xlabel(self):
+        return False if self.xlabel == "" else True
+
+    @cached_property
+    def ylabel(self):
+        return self._ax.get_yaxis().get_label().get_text()
+
+    @cached_property
+    def has_ylabel(self):
+        return False if self.ylabel == "" else True
+
+    @cached_property
+    def xtick_label(self):
+        with _timed("extract", "text", calls=0) as timer:
+            labels = TextList(self._ax.get_xaxis().get_ticklabels())
+            timer.add(calls=len(labels))
+        return labels
+
+    @cached_property
+    def ytick_label(self):
+        with _timed("extract", "text", calls=0) as timer:
+            labels = TextList(self._ax.get_yaxis().get_ticklabels())
+            timer.add(calls=len(labels))
+        return labels
+
+    @cached_property
+    def x_scale(self):
+        return self._ax.get_xscale()
+
+    @cached_property
+    def y_scale(self):
+        return self._ax.get_yscale()
+
+    @cached_property
+    def sharex(self):
+        if self._ax._sharex:
+            return self._ax.get_figure().get_axes().index(self._ax._sharex)
+        return None
+
+    @cached_property
+    def sharey(self):
+        if self._ax._sharey:
+            return self._ax.get_figure().get_axes().index(self._ax._sharey)
+        return None
+
+    @cached_property
+    def legend_entries(self):
+        legend = self._ax.get_legend()
+        if legend:
+            return TextList(legend.get_texts())
+        return TextList([None])
+
+    @cached_property
+    def num_legend_entries(self):
+        return len(self.legend_entries) if self.has_legend else 0
+
+    @cached_property
+    def has_legend(self):
+        return True if self._ax.get_legend() else False
+
+    @cached_property
+    def grid_spec(self):
+        return self._ax.get_gridspec().get_geometry()
+
+    # sort the lines, path_collections and patches, so that
+    # the order that they get plotted in doesn't matter
+    @cached_property
+    def lines(self):
+        with _timed("extract", "line", calls=0) as timer:
+            lines = [Line(line) for line in self._ax.get_lines()
+                     if line.get_xdata().size!=0]
+            if timer:
+                timer.add(len(lines), sum(map(_data_size, lines)))
+        with _timed("sort", "line", calls=len(lines)):
+            return sorted(lines)
+
+    @cached_property
+    def path_collections(self):
+        with _timed("extract", "path_collection", calls=0) as timer:
+            pcs = [PathCollection(pc) for pc in self._ax.collections]
+            if timer:
+                timer.add(len(pcs), sum(map(_data_size, pcs)))
+        with _timed("sort", "path_collection", calls=len(pcs)):
+            return sorted(pcs)
+
+    @cached_property
+    def patches(self):
+        with _timed("extract", "patch", calls=len(self._ax.patches)):
+            return PatchArray(self._ax.patches)
+
+    def extract(self):
+        """
+        Read every property from the matplotlib axis now, and drop the
+        references to it and its artists. Returns the axis.
+        """
+        for attr in self._lazy_attrs:
+            getattr(self, attr)
+        self.__dict__.pop("_ax", None)
+        return self
+
+    def _pack(self, arrays):
+        """Return the json-able header for the axis, storing arrays in `arrays`"""
+        return {
+            "title": self.title,
+            "has_title": self.has_title,
+            "xlabel": self.xlabel,
+            "has_xlabel": self.has_xlabel,
+            "ylabel": self.ylabel,
+            "has_ylabel": self.has_ylabel,
+            "xtick_label": self.xtick_label._pack(),
+            "ytick_label": self.ytick_label._pack(),
+            "x_scale": self.x_scale,
+            "y_scale": self.y_scale,
+            "legend_entries": self.legend_entries._pack(),
+            "num_legend_entries": self.num_legend_entries,
+            "has_legend": self.has_legend,
+            "grid_spec": list(self.grid_spec) if self.grid_spec else None,
+            "sharex": self.sharex,
+            "sharey": self.sharey,
+            "lines": [line._pack(arrays) for line in self.lines],
+            "path_collections": [pc._pack(arrays) for pc in self.path_collections],
+            "patches": self.patches._pack(arrays),
+        }
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build an axis from a header written by `_pack`"""
+        ax = dict(meta)
+        ax["xtick_label"] = TextList._unpack(meta["xtick_label"] or [])
+        ax["ytick_label"] = TextList._unpack(meta["ytick_label"] or [])
+        ax["legend_entries"] = TextList._unpack(meta["legend_entries"] or [])
+        if meta["grid_spec"] is not None:
+            ax["grid_spec"] = tuple(meta["grid_spec"])
+        ax["lines"] = [Line._unpack(line, arrays) for line in meta["lines"]]
+        ax["path_collections"] = [PathCollection._unpack(pc, arrays)
+                                  for pc in meta["path_collections"]]
+        ax["patches"] = PatchArray._unpack(meta["patches"], arrays)
+        return cls(ax)
+
+    @cached_property
+    def digest(self):
+        """Hex digest of the content of the axis and everything on it"""
+        return _digest([getattr(self, attr) for attr in self.all_attrs],
+                       [line.digest for line in self.lines],
+                       [pc.digest for pc in self.path_collections],
+                       self.patches.digest)
 
     def get_num_pc(self):
         """Return the number of path_collections"""
@@ -294,59 +2047,118 @@ class Axis:
         rep += '        "lines": ' + f"{lines_repr},\n"
         pc_repr = repr([pc for pc in self.path_collections])
         rep += f'        "path_collections": {pc_repr},\n'
-        patch_repr = repr([patch for patch in self.patches])
-        rep += f'        "patches": {patch_repr},\n'
+        rep += f'        "patches": {self.patches},\n'
         rep += "    })\n"
         return rep
 
-    def assert_similar(self, other, attrs=None, tol=None):
+    def assert_similar(self, other, attrs=None, tol=None, ordered_scatter=True,
+                       matching="optimal"):
         """Assert that the axis is similar to another axis"""
+        self._diff(other, attrs, tol, ordered_scatter, matching,
+                   _DiffReport(first_only=True))
+
+    def _diff(self, other, attrs, tol, ordered_scatter, matching, report, path=()):
+        """Add the differences between the axes to `report`"""
+        if matching not in ("sorted", "optimal"):
+            raise ValueError(f"Unknown matching {matching!r}")
         test_attrs = self.all_attrs if not attrs else attrs
 
         # test all the attributes that relate to an axes
+        report.checked(set(test_attrs).intersection(self.all_attrs))
         for attr in set(test_attrs).intersection(self.all_attrs):
             if attr in ["xtick_label", "ytick_label", "legend_entries"]:
-                # It seems that matplotlib.text.Text doesn't implement __eq__
-                # so here we are doing matplotlib's job for them...
-                for text, text_ref in zip(getattr(self, attr),
-                                          getattr(other, attr)):
-                    if not check_text_equal(text, text_ref):
-                        raise AssertionError(f"Incorrect {attr}: "
-                                             f"'{getattr(other, attr)}', "
-                                             f"Expected '{getattr(self, attr)}'")
+                with _timed("compare", "text", calls=0) as timer:
+                    texts, other_texts = getattr(self, attr), getattr(other, attr)
+                    timer.add(calls=min(len(texts), len(other_texts)))
+                    index = texts.first_difference(other_texts)
+                    if index is not None:
+                        report.add(path, attr, list(texts), list(other_texts),
+                                   f"Incorrect {attr}: "
+                                   f"'{list(other_texts)}', "
+                                   f"Expected '{list(texts)}'\n"
+                                   f"First difference at index {index}")
 
-            elif getattr(self, attr) != getattr(other, attr):
-                raise AssertionError(f"Incorrect {attr}, "
-                                     f"'{getattr(other, attr)}'.  "
-                                     f"Expected '{getattr(self, attr)}'")
+            else:
+                with _timed("compare", "axis"):
+                    if getattr(self, attr) != getattr(other, attr):
+                        report.add(path, attr, getattr(self, attr),
+                                   getattr(other, attr),
+                                   f"Incorrect {attr}, "
+                                   f"'{getattr(other, attr)}'.  "
+                                   f"Expected '{getattr(self, attr)}'",
+                                   error=lambda: _max_abs_error(
+                                       getattr(self, attr), getattr(other, attr)))
 
         if attrs is None or common_element(attrs, Line.all_attrs):
             # check that the lines are similar. The lines may be in a different order
+            line_attrs = set(attrs or Line.all_attrs).intersection(Line.all_attrs)
+            num_lines = max(self.get_num_lines(), other.get_num_lines())
             if self.get_num_lines() != other.get_num_lines():
-                raise AssertionError(f"Incorrect number of lines. "
-                                    f"Expected {self.get_num_lines()}, "
-                                    f"found {other.get_num_lines()}")
-            for line, other_line in zip(self.lines, other.lines):
-                line.assert_similar(other_line, attrs, tol=tol)
+                report.checked(line_attrs, num_lines, failed=num_lines)
+                report.add(path, "lines", self.get_num_lines(),
+                           other.get_num_lines(),
+                           f"Incorrect number of lines. "
+                           f"Expected {self.get_num_lines()}, "
+                           f"found {other.get_num_lines()}",
+                           error=abs(self.get_num_lines() - other.get_num_lines()))
+            else:
+                report.checked(line_attrs, num_lines)
+                with _timed("compare", "line", calls=self.get_num_lines()) as timer:
+                    if timer:
+                        timer.add(size=sum(map(_data_size, self.lines)))
+                    _diff_pairs(self.lines, other.lines,
+                                lambda line, other_line, report, path: line._diff(
+                                    other_line, attrs, tol, report, path),
+                                Line._match_features, attrs or Line.all_attrs,
+                                report, path + ("lines",),
+                                rematch=matching == "optimal")
 
         if attrs is None or common_element(attrs, PathCollection.all_attrs):
             # check that the path collections are similar
+            pc_attrs = set(attrs or PathCollection.all_attrs).intersection(
+                PathCollection.all_attrs)
+            num_pcs = max(self.get_num_pc(), other.get_num_pc())
             if self.get_num_pc() != other.get_num_pc():
-                raise AssertionError(f"Incorrect number of items in the"
-                                    f"scatter plot. Expected {self.get_num_pc()} "
-                                    f"found {other.get_num_pc()}")
-            for pc, other_pc in zip(self.path_collections, other.path_collections):
-                pc.assert_similar(other_pc, attrs, tol=tol)
-
-
-        if attrs is None or common_element(attrs, Wedge.all_attrs) or common_element(attrs, Rectangle.all_attrs):
+                report.checked(pc_attrs, num_pcs, failed=num_pcs)
+                report.add(path, "path_collections", self.get_num_pc(),
+                           other.get_num_pc(),
+                           f"Incorrect number of items in the"
+                           f"scatter plot. Expected {self.get_num_pc()} "
+                           f"found {other.get_num_pc()}",
+                           error=abs(self.get_num_pc() - other.get_num_pc()))
+            else:
+                report.checked(pc_attrs, num_pcs)
+                with _timed("compare", "path_collection",
+                            calls=self.get_num_pc()) as timer:
+                    if timer:
+                        timer.add(size=sum(map(_data_size, self.path_collections)))
+                    _diff_pairs(self.path_collections, other.path_collections,
+                                lambda pc, other_pc, report, path: pc._diff(
+                                    other_pc, attrs, tol, ordered_scatter,
+                                    report, path),
+                                PathCollection._match_features,
+                                attrs or PathCollection.all_attrs,
+                                report, path + ("path_collections",),
+                                rematch=matching == "optimal")
+
+
+        if attrs is None or common_element(attrs, PatchArray.all_attrs):
             # check that the patches are similar
             if self.get_num_patches() != other.get_num_patches():
-                raise AssertionError("Incorrect number of patches "
-                                    f"Expected {self.get_num_patches()} "
-                                    f"but got {other.get_num_patches()}")
-            for patch, other_patch in zip(self.patches, other.patches):
-                    patch.assert_similar(other_patch, attrs, tol=tol)
+                num_patches = max(self.get_num_patches(), other.get_num_patches())
+                report.checked(set(attrs or PatchArray.all_attrs).intersection(
+                    PatchArray.all_attrs), num_patches, failed=num_patches)
+                report.add(path, "patches", self.get_num_patches(),
+                           other.get_num_patches(),
+                           "Incorrect number of patches "
+                           f"Expected {self.get_num_patches()} "
+                           f"but got {other.get_num_patches()}",
+                           error=abs(self.get_num_patches()
+                                     - other.get_num_patches()))
+            else:
+                with _timed("compare", "patch", calls=self.get_num_patches()):
+                    self.patches._diff(other.patches, attrs, tol, matching,
+                                       report, path + ("patches",))
 
 def create_patch(patch):
     if isinstance(patch, matplotlib.patches.Wedge):
@@ -360,14 +2172,18 @@ class Patch:
     """
     Representation of a matplotlib patch
     """
+    __slots__ = ()
+
     def check_similar(self, other, attrs=None, tol=None):
         test_attrs = self.all_attrs if not attrs else attrs
         if self.patch_type != other.patch_type:
             msg = f"Incorrect shape. Expected {self.patch_type}, got {other.patch_type}"
             return False, msg
         test_attrs = self.all_attrs if not attrs else attrs
+        abs_tol = 0.0 if tol is None else tol
         for attr in set(test_attrs).intersection(self.all_attrs):
-            if not math.isclose(getattr(self, attr), getattr(other, attr)):
+            if not math.isclose(getattr(self, attr), getattr(other, attr),
+                                abs_tol=abs_tol):
                 msg = f"Incorrect {self.patch_type} {attr}: {getattr(other, attr)}. "
                 msg += f"Expected {getattr(self, attr)}"
                 return False, msg
@@ -379,6 +2195,22 @@ class Patch:
         if not similar:
             raise AssertionError(msg)
 
+    @property
+    def digest(self):
+        """Hex digest of the patch"""
+        return _digest(self.patch_type, [getattr(self, attr) for attr in self._fields])
+
+    def _pack(self, arrays):
+        """Return the json-able header for the patch"""
+        meta = {attr: float(getattr(self, attr)) for attr in self._fields}
+        meta["patch_type"] = self.patch_type
+        return meta
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build a patch from a header written by `_pack`"""
+        return cls({attr: meta[attr] for attr in cls._fields})
+
     def __eq__(self, other):
         similar, _ = self.check_similar(other)
         return similar
@@ -399,6 +2231,8 @@ class Rectangle(Patch):
     """
     patch_type = "rectangle"
     all_attrs = ("position_x", "height", "width", "position_y")
+    _fields = ("height", "width", "position_x", "position_y")
+    __slots__ = _fields
 
     def __init__(self, rectangle):
         if isinstance(rectangle, dict):
@@ -426,6 +2260,8 @@ class Wedge(Patch):
     """
     patch_type = "wedge"
     all_attrs = ("theta", "r", "theta1", "theta2", "center_x", "center_y")
+    _fields = ("r", "theta1", "theta2", "center_x", "center_y")
+    __slots__ = _fields + ("theta",)
 
     def __init__(self, wedge):
         if isinstance(wedge, dict):
@@ -459,6 +2295,8 @@ class Circle(Patch):
     """
     patch_type = "circle"
     all_attrs = ("radius", "center_x", "center_y")
+    _fields = ("radius", "center_x", "center_y")
+    __slots__ = _fields
 
     def __init__(self, circle):
         if isinstance(circle, dict):
@@ -476,6 +2314,272 @@ class Circle(Patch):
         rep += "})"
         return rep
 
+_patch_types = {patch_type.patch_type: patch_type
+                for patch_type in (Rectangle, Wedge, Circle)}
+
+
+class PatchArray:
+    """
+    Representation of all the patches on an axis.
+
+    The patches are stored as numpy columns, with one row per patch, so that
+    axes with thousands of patches (e.g. histograms) can be sorted and
+    compared with a few vectorised operations. `kind` indexes into
+    `patch_types`, and the other columns are NaN where they don't apply
+    to the kind of patch.
+    """
+    patch_types = (Rectangle, Wedge, Circle)
+    columns = ("x", "y", "width", "height", "r", "theta1", "theta2")
+    all_attrs = tuple(sorted(set(Rectangle.all_attrs + Wedge.all_attrs
+                                 + Circle.all_attrs)))
+    # the column holding each attribute, for each kind of patch
+    _attr_columns = {
+        "rectangle": {"position_x": "x", "position_y": "y",
+                      "width": "width", "height": "height"},
+        "wedge": {"center_x": "x", "center_y": "y", "r": "r",
+                  "theta1": "theta1", "theta2": "theta2", "theta": None},
+        "circle": {"center_x": "x", "center_y": "y", "radius": "r"},
+    }
+
+    def __init__(self, patches):
+        """
+        Parameters:
+            patches: A dictionary of columns, another PatchArray, or a
+                sequence of matplotlib patches and/or Rectangle, Wedge and
+                Circle objects. Other kinds of patch are ignored.
+        """
+        if isinstance(patches, PatchArray):
+            self.kind = patches.kind
+            for column in self.columns:
+                setattr(self, column, getattr(patches, column))
+            return
+
+        if isinstance(patches, dict):
+            self.kind = np.asarray(patches["kind"], dtype=np.int8)
+            for column in self.columns:
+                setattr(self, column, np.asarray(patches[column], dtype=float))
+        else:
+            rows = [row for row in map(_patch_row, patches) if row is not None]
+            table = np.array(rows, dtype=float).reshape(len(rows), 8)
+            self.kind = table[:, 0].astype(np.int8)
+            for i, column in enumerate(self.columns):
+                setattr(self, column, table[:, i + 1])
+
+        # sort the patches, so that the order that they get plotted
+        # in doesn't matter
+        order = np.lexsort(self._sort_keys()[::-1])
+        self.kind = self.kind[order]
+        for column in self.columns:
+            setattr(self, column, getattr(self, column)[order])
+
+    def __len__(self):
+        return len(self.kind)
+
+    @cached_property
+    def digest(self):
+        """Hex digest of the patches"""
+        return _digest(self.kind, [getattr(self, column) for column in self.columns])
+
+    def __getitem__(self, i):
+        patch_type = self.patch_types[self.kind[i]]
+        return patch_type({attr: float(self.get_attr(attr)[i])
+                           for attr in patch_type._fields})
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        # NaN is written as None, which numpy reads back as NaN
+        rep = "PatchArray({"
+        rep += f'"kind": {self.kind.tolist()}, '
+        rep += ", ".join(f'"{column}": '
+                         f'{np.where(np.isnan(getattr(self, column)), None, getattr(self, column)).tolist()}'
+                         for column in self.columns)
+        rep += "})"
+        return rep
+
+    def get_attr(self, attr):
+        """
+        Return the values of a patch attribute (e.g. "position_x" or
+        "theta") for every patch, with NaN for patches without that attribute
+        """
+        values = np.full(len(self), np.nan)
+        for kind, patch_type in enumerate(self.patch_types):
+            column = self._attr_columns[patch_type.patch_type].get(attr, False)
+            if column is False:
+                continue
+            rows = self.kind == kind
+            if column is None:
+                values[rows] = np.abs(self.theta1[rows] - self.theta2[rows])
+            else:
+                values[rows] = getattr(self, column)[rows]
+        return values
+
+    def _sort_keys(self):
+        """
+        The keys to sort the patches by, most significant first: the kind of
+        patch, followed by its attributes in the order of `all_attrs` for
+        that kind of patch
+        """
+        num_keys = max(len(patch_type.all_attrs) for patch_type in self.patch_types)
+        keys = [np.zeros(len(self)) for _ in range(num_keys)]
+        for kind, patch_type in enumerate(self.patch_types):
+            rows = self.kind == kind
+            if not rows.any():
+                continue
+            for key, attr in zip(keys, patch_type.all_attrs):
+                key[rows] = self.get_attr(attr)[rows]
+        return [self.kind] + keys
+
+    def check_similar(self, other, attrs=None, tol=None, matching="optimal"):
+        """
+        Check if the patches are similar to the patches in `other`. See
+        `assert_similar_figures` for `matching`.
+        """
+        if len(self) != len(other):
+            msg = (f"Incorrect number of patches. Expected {len(self)}, "
+                   f"got {len(other)}")
+            return False, msg
+        try:
+            self._diff(other, attrs, tol, matching, _DiffReport(first_only=True))
+        except AssertionError as error:
+            return False, str(error)
+        return True, None
+
+    def _diff(self, other, attrs, tol, matching, report, path=()):
+        """
+        Add the differences between the patches to `report`, which are in
+        the order of the rows. `other` must have the same number of patches.
+        """
+        test_attrs = self.all_attrs if not attrs else attrs
+        if matching == "optimal":
+            other = self._rematch(other, test_attrs, tol)
+        wrong_kind = np.flatnonzero(self.kind != other.kind)
+        for i in wrong_kind:
+            expected = self.patch_types[self.kind[i]].patch_type
+            found = self.patch_types[other.kind[i]].patch_type
+            report.add(path + (int(i),), "shape", expected, found,
+                       f"Incorrect shape. Expected {expected}, got {found}")
+
+        atol = 0.0 if tol is None else tol
+        attrs = [attr for attr in self.all_attrs if attr in test_attrs]
+        if report.first_only:
+            # only the earliest row with a difference is needed, and
+            # first_difference stops at it without comparing the rest
+            first_wrong = None
+            for attr in attrs:
+                values, other_values = self.get_attr(attr), other.get_attr(attr)
+                # NaN marks attributes which don't apply to a patch
+                i = first_difference(values, other_values, tol=atol, rtol=1e-9,
+                                     equal_nan=True)
+                if i is not None and (first_wrong is None or i < first_wrong[0]):
+                    first_wrong = i, attr
+            wrong = [first_wrong] if first_wrong is not None else []
+        else:
+            right_kind = self.kind == other.kind
+            wrong = []
+            for attr in attrs:
+                values, other_values = self.get_attr(attr), other.get_attr(attr)
+                # the patches the attribute applies to, where a patch of the
+                # wrong shape fails it without being another difference
+                applies = ~(np.isnan(values) & np.isnan(other_values))
+                report.checked((attr,), np.count_nonzero(applies),
+                               failed=np.count_nonzero(applies & ~right_kind))
+                if report.measure:
+                    report.measure_error(attr, values[right_kind],
+                                         other_values[right_kind])
+                close = np.isclose(values, other_values, rtol=1e-9, atol=atol,
+                                   equal_nan=True)
+                wrong.extend((int(i), attr)
+                             for i in np.flatnonzero(~close & right_kind))
+            wrong.sort(key=lambda row: (row[0], attrs.index(row[1])))
+
+        for i, attr in wrong:
+            value, other_value = self.get_attr(attr)[i], other.get_attr(attr)[i]
+            report.add(path + (int(i),), attr, value, other_value,
+                       f"Incorrect {self.patch_types[self.kind[i]].patch_type} "
+                       f"{attr}: {other_value}. Expected {value}",
+                       error=lambda: _max_abs_error(value, other_value))
+
+    def _rematch(self, other, test_attrs, tol):
+        """
+        `other` with the patches which aren't similar to the patch in the
+        same row of this array paired again, so they are as close as
+        possible. See `_rematch`.
+        """
+        atol = 0.0 if tol is None else tol
+        attrs = [attr for attr in self.all_attrs if attr in test_attrs]
+        values = np.column_stack([self.get_attr(attr) for attr in attrs] or
+                                 [np.zeros(len(self))])
+        other_values = np.column_stack([other.get_attr(attr) for attr in attrs] or
+                                       [np.zeros(len(other))])
+        similar = ((self.kind == other.kind)
+                   & np.isclose(values, other_values, rtol=1e-9, atol=atol,
+                                equal_nan=True).all(axis=1))
+        failing = np.flatnonzero(~similar)
+        if len(failing) < 2 or len(failing) > MATCH_LIMIT:
+            return other
+        matched = _match(values[failing], other_values[failing],
+                         self.kind[failing, None].astype(str),
+                         other.kind[failing, None].astype(str))
+        order = np.arange(len(other))
+        order[failing] = failing[matched]
+        return other._take(order)
+
+    def _take(self, order):
+        """The patches in the rows `order`, in that order"""
+        patches = PatchArray.__new__(PatchArray)
+        patches.kind = self.kind[order]
+        for column in self.columns:
+            setattr(patches, column, getattr(self, column)[order])
+        return patches
+
+    def assert_similar(self, other, attrs=None, tol=None, matching="optimal"):
+        """ Assert the patches are similar to the patches in `other` """
+        similar, msg = self.check_similar(other, attrs, tol=tol, matching=matching)
+        if not similar:
+            raise AssertionError(msg)
+
+    def _pack(self, arrays):
+        """Return the json-able header for the patches, storing arrays in `arrays`"""
+        meta = {"kind": _store_array(arrays, self.kind)}
+        for column in self.columns:
+            meta[column] = _store_array(arrays, getattr(self, column))
+        return meta
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build the patches from a header written by `_pack`"""
+        return cls({column: _load_array(arrays, key)
+                    for column, key in meta.items()})
+
+def _patch_row(patch):
+    """
+    Return the row of a PatchArray describing a matplotlib patch or a
+    Rectangle, Wedge or Circle, or None for other kinds of patch
+    """
+    nan = np.nan
+    if isinstance(patch, (Rectangle, matplotlib.patches.Rectangle)):
+        if isinstance(patch, Rectangle):
+            x, y = patch.position_x, patch.position_y
+            width, height = patch.width, patch.height
+        else:
+            (x, y), width, height = patch.get_xy(), patch.get_width(), patch.get_height()
+        return (0, x, y, width, height, nan, nan, nan)
+    if isinstance(patch, (Wedge, matplotlib.patches.Wedge)):
+        if isinstance(patch, Wedge):
+            x, y = patch.center_x, patch.center_y
+        else:
+            x, y = patch.center
+        return (1, x, y, nan, nan, patch.r, patch.theta1, patch.theta2)
+    if isinstance(patch, (Circle, matplotlib.patches.Circle)):
+        if isinstance(patch, Circle):
+            x, y = patch.center_x, patch.center_y
+        else:
+            x, y = patch.center
+        return (2, x, y, nan, nan, patch.radius, nan, nan)
+    return None
+
 
 @total_ordering
 class PathCollection:
@@ -485,6 +2589,20 @@ class PathCollection:
     data in a scatter plot
     """
     all_attrs = ("x_data", "y_data", "marker")
+    __slots__ = all_attrs + ("_sort_key", "_digest")
+
+    @staticmethod
+    def _match_features(pcs, attrs):
+        """The numbers and labels `_rematch` pairs scatter plots by"""
+        values = np.array([np.concatenate(
+            [[np.size(pc.x_data)]]
+            + [_sampled(getattr(pc, attr), sort=True)
+               for attr in ("x_data", "y_data") if attr in attrs])
+            for pc in pcs])
+        labels = np.array([[_digest(pc.marker)] if "marker" in attrs else []
+                           for pc in pcs], dtype=str).reshape(len(pcs), -1)
+        return values, labels
+
     def __init__(self, pc):
         if isinstance(pc, dict):
             self.x_data = pc.get("x_data")
@@ -495,6 +2613,8 @@ class PathCollection:
             self.x_data = data[:, 0]
             self.y_data = data[:, 1]
             self.marker = pc.get_paths()[0]
+        self._sort_key = None
+        self._digest = None
 
     def __repr__(self):
         rep = f'         {{"x_data": np.{repr(self.x_data)}, \n'
@@ -502,66 +2622,398 @@ class PathCollection:
         rep += f'        "marker": {self.marker} }}'
         return rep
 
+    def _pack(self, arrays):
+        """Return the json-able header for the collection, storing arrays in `arrays`"""
+        return {
+            "x_data": _store_array(arrays, self.x_data),
+            "y_data": _store_array(arrays, self.y_data),
+            "marker_vertices": _store_array(arrays, self.marker.vertices),
+            "marker_codes": _store_array(arrays, self.marker.codes),
+        }
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build a collection from a header written by `_pack`"""
+        return cls({
+            "x_data": _load_array(arrays, meta["x_data"]),
+            "y_data": _load_array(arrays, meta["y_data"]),
+            "marker": Path(_load_array(arrays, meta["marker_vertices"]),
+                           _load_array(arrays, meta["marker_codes"])),
+        })
+
     def __eq__(self, other):
         eq, _ = self.check_similar(other)
         if eq:
             return True
         return False
 
+    @property
+    def sort_key(self):
+        """
+        Key which puts path collections in a canonical order. It only depends
+        on the set of points in the collection, not the order they were
+        plotted in, and is built once with vectorised numpy operations.
+        """
+        if self._sort_key is None:
+            self._sort_key = (_array_head(self.marker.vertices),
+                              np.size(self.x_data),
+                              _array_head(_smallest(self.x_data)),
+                              _array_head(_smallest(self.y_data)),
+                              _array_sum(self.x_data), _array_sum(self.y_data))
+        return self._sort_key
+
+    @property
+    def digest(self):
+        """Hex digest of the points and marker, computed once"""
+        if self._digest is None:
+            self._digest = _digest(self.x_data, self.y_data, self.marker)
+        return self._digest
+
     def __gt__(self, other):
-        if self.marker.vertices.tolist() > other.marker.vertices.tolist():
-            return True
-        if self.marker.vertices.tolist() < other.marker.vertices.tolist():
-            return False
-        if list(self.x_data) > list(other.x_data):
-            return True
-        if list(self.x_data) < list(other.x_data):
-            return False
-        if list(self.y_data) > list(other.y_data):
-            return True
-        if list(self.y_data) < list(other.y_data):
-            return False
-        return False
+        return self.sort_key > other.sort_key
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+    def check_similar(self, other, attrs=None, tol=None, ordered=True):
+        """
+        Check if two PathCollections are similar
+
+        If `ordered` is False, the points are compared as a set, so
+        plotting the same points in a different order is still similar.
+        """
+        try:
+            self._diff(other, attrs, tol, ordered, _DiffReport(first_only=True))
+        except AssertionError as error:
+            return False, str(error)
+        return True, None
 
-    def check_similar(self, other, attrs=None, tol=None):
-        """ Check if two PathCollections are similar """
+    def _diff(self, other, attrs, tol, ordered, report, path=()):
+        """Add the differences between the PathCollections to `report`"""
         test_attrs = self.all_attrs if not attrs else attrs
+        if not ordered and {"x_data", "y_data"}.issubset(test_attrs):
+            if report.measure:
+                report.measure_error("x_data", np.sort(self.x_data),
+                                     np.sort(other.x_data))
+                report.measure_error("y_data", np.sort(self.y_data),
+                                     np.sort(other.y_data))
+            if not same_point_sets(self.x_data, self.y_data,
+                                   other.x_data, other.y_data, tol=tol):
+                report.add(path, "x_data, y_data",
+                           (self.x_data, self.y_data),
+                           (other.x_data, other.y_data),
+                           "Scatter plot has points in the wrong place")
+            test_attrs = set(test_attrs) - {"x_data", "y_data"}
         for attr in set(test_attrs).intersection(self.all_attrs):
             if attr in ("x_data", "y_data"):
-                try:
-                    data_correct = np.allclose(getattr(self, attr),
-                                               getattr(other, attr),
-                                               atol=tol)
-                except ValueError:
-                    data_correct = False
-                finally:
-                    if not data_correct:
-                        msg = "Scatter plot has points in the wrong place"
-                        return False, msg
+                data, other_data = getattr(self, attr), getattr(other, attr)
+                if not ordered:
+                    data, other_data = np.sort(data), np.sort(other_data)
+                report.measure_error(attr, data, other_data)
+                if first_difference(data, other_data, tol=tol) is not None:
+                    msg = "Scatter plot has points in the wrong place"
+                    report.add(path, attr, getattr(self, attr),
+                               getattr(other, attr), msg,
+                               error=lambda: _max_abs_error(data, other_data))
             elif attr == "marker":
-                try:
-                    vert_correct = np.allclose(self.marker.vertices,
-                                               other.marker.vertices,
-                                               atol=tol)
-                    code_correct = np.allclose(self.marker.vertices,
-                                               other.marker.vertices,
-                                               atol=tol)
-                    marker_correct = vert_correct and code_correct
-
-                except ValueError:
-                    marker_correct = False
-                if not marker_correct:
-                    return False, "Incorrect marker in scatter plot"
-        return True, None
-
-
-    def assert_similar(self, other, attrs=None, tol=None):
+                vert_correct = first_difference(self.marker.vertices,
+                                                other.marker.vertices,
+                                                tol=tol) is None
+                if self.marker.codes is None or other.marker.codes is None:
+                    code_correct = self.marker.codes is other.marker.codes
+                else:
+                    code_correct = first_difference(self.marker.codes,
+                                                    other.marker.codes) is None
+                if not (vert_correct and code_correct):
+                    report.add(path, attr, self.marker, other.marker,
+                               "Incorrect marker in scatter plot")
+
+
+    def assert_similar(self, other, attrs=None, tol=None, ordered=True):
         """ Assert two PathCollections are similar """
         test_attrs = self.all_attrs if not attrs else attrs
-        similar, msg = self.check_similar(other, test_attrs, tol=tol)
+        similar, msg = self.check_similar(other, test_attrs, tol=tol,
+                                          ordered=ordered)
         if not similar:
             raise AssertionError(msg)
 
+MATCH_LIMIT = 512
+
+def _diff_pairs(items, other_items, diff, features, attrs, report, path,
+                rematch=True):
+    """
+    Add the differences between the lines (or scatter plots) in `items` and
+    `other_items`, which are both sorted and the same length, to `report`.
+    The i'th pair is compared with `diff(item, other_item, report, path + (i,))`.
+
+    If `rematch`, the pairs which aren't similar are paired again first, see
+    `_rematch`. Each pair is only compared once, unless it is paired again.
+    """
+    if not rematch or len(items) < 2:
+        for i, (item, other_item) in enumerate(zip(items, other_items)):
+            diff(item, other_item, report, path + (i,))
+        return
+    pair_reports = [report.diff_pair(diff, item, other_item, path + (i,))
+                    for i, (item, other_item) in enumerate(zip(items, other_items))]
+    failing = [i for i, pair_report in enumerate(pair_reports) if pair_report.failed]
+    rematched = _rematch(items, other_items, failing, features, attrs)
+    for i, (item, other_item) in enumerate(zip(items, rematched)):
+        if other_item is other_items[i]:
+            report.merge(pair_reports[i])
+        else:
+            diff(item, other_item, report, path + (i,))
+
+def _rematch(items, other_items, failing, features, attrs):
+    """
+    Pair the lines (or scatter plots) in `items` with those in `other_items`,
+    which are both sorted. Pairs of the sorted lists which aren't in `failing`,
+    the indexes of the pairs which aren't similar, are kept, and the rest are
+    paired again so that their `features` are as close as possible, as a
+    small difference can change the order they sort in. At most `MATCH_LIMIT`
+    items are paired again.
+
+    Returns:
+        list: `other_items` in the order which pairs them with `items`
+    """
+    if len(failing) < 2 or len(failing) > MATCH_LIMIT:
+        return other_items
+    values, labels = features([items[i] for i in failing], attrs)
+    other_values, other_labels = features([other_items[i] for i in failing], attrs)
+    matched = _match(values, other_values, labels, other_labels)
+    other_items = list(other_items)
+    other_failing = [other_items[i] for i in failing]
+    for i, j in zip(failing, matched):
+        other_items[i] = other_failing[j]
+    return other_items
+
+def _match(values, other_values, labels=None, other_labels=None):
+    """
+    Pair the rows of `values` with the rows of `other_values` so that the
+    total distance between the pairs is as small as possible. Pairs with
+    fewer `labels` which differ, or values which are NaN in only one of
+    them, are always preferred, whatever the distance between their values.
+
+    Parameters:
+        values, other_values (numpy.ndarray): (n, k) arrays of numbers
+        labels, other_labels (numpy.ndarray): (n, m) arrays of strings
+
+    Returns:
+        numpy.ndarray: The row of `other_values` paired with each row of `values`
+    """
+    values, other_values = values[:, None, :], other_values[None, :, :]
+    with np.errstate(invalid="ignore", over="ignore"):
+        same = (values == other_values) | (np.isnan(values) & np.isnan(other_values))
+        distance = np.where(same, 0.0, np.abs(values - other_values))
+    invalid = ~np.isfinite(distance)
+    mismatches = invalid.sum(axis=-1)
+    distance = np.where(invalid, 0.0, distance).sum(axis=-1)
+    if labels is not None:
+        mismatches += (labels[:, None, :] != other_labels[None, :, :]).sum(axis=-1)
+    scale = distance.max() + 1 if distance.size else 1
+    return _solve_assignment(mismatches * scale + distance)
+
+def _solve_assignment(cost):
+    """
+    Index of the column assigned to each row of a square cost matrix, with
+    the smallest total cost if scipy is installed, otherwise greedily
+    """
+    if linear_sum_assignment is not None:
+        _, columns = linear_sum_assignment(cost)
+        return columns
+    columns = np.full(len(cost), -1)
+    used = np.zeros(len(cost), dtype=bool)
+    remaining = len(cost)
+    for index in np.argsort(cost, axis=None, kind="stable"):
+        row, column = divmod(int(index), len(cost))
+        if columns[row] == -1 and not used[column]:
+            columns[row] = column
+            used[column] = True
+            remaining -= 1
+            if not remaining:
+                break
+    return columns
+
+def _sampled(array, size=8, sort=False):
+    """
+    `size` evenly spaced values of an array (or of the array sorted), as
+    floats, or NaN if it is empty or not numbers
+    """
+    try:
+        array = np.asarray(array, dtype=float).ravel()
+    except (TypeError, ValueError):
+        return np.full(size, np.nan)
+    if not array.size:
+        return np.full(size, np.nan)
+    if sort:
+        array = np.sort(array)
+    return array[np.linspace(0, array.size - 1, size).round().astype(int)]
+
+def _default_atol(tol):
+    """The absolute tolerance to use when none is given"""
+    return 1e-8 if tol is None else tol
+
+COMPARE_BLOCK_SIZE = 1 << 14
+
+def _max_abs_error(ref, other):
+    """
+    The largest absolute difference between `ref` and `other`, or None if
+    they aren't numbers or numeric arrays of the same shape
+    """
+    try:
+        ref, other = np.asarray(ref), np.asarray(other)
+    except (TypeError, ValueError):
+        return None
+    if (ref.shape != other.shape or ref.size == 0
+            or ref.dtype.kind not in "biuf" or other.dtype.kind not in "biuf"):
+        return None
+    with np.errstate(invalid="ignore"):
+        error = np.abs(ref.astype(float) - other.astype(float))
+    return float(np.nanmax(error)) if not np.isnan(error).all() else None
+
+def first_difference(ref, other, tol=None, rtol=1e-5, equal_nan=False,
+                     block_size=COMPARE_BLOCK_SIZE):
+    """
+    Find the first element of `other` which isn't close to `ref`.
+
+    Elements are close if |ref - other| <= tol + rtol * |other|, as in
+    np.allclose(ref, other). Dates, strings and booleans must be equal.
+    The arrays are compared in blocks of `block_size` elements, reusing
+    the same small buffers, and the comparison stops at the first block
+    with a difference, so large arrays aren't copied and a difference
+    near the start is found quickly.
+
+    Parameters:
+        ref (array_like): The reference data
+        other (array_like): The data to compare to the reference
+        tol (float): The absolute tolerance
+        rtol (float): The relative tolerance
+        equal_nan (bool): Whether NaN in both arrays counts as close
+
+    Returns:
+        int or None: The index of the first difference, or None if the
+        arrays are close. If the arrays have different lengths, but one
+        starts with the other, the index is the length of the shorter array.
+    """
+    ref, other = np.ravel(ref), np.ravel(other)
+    size = min(ref.size, other.size)
+    atol = _default_atol(tol)
+    numeric = ref.dtype.kind in "iuf" and other.dtype.kind in "iuf"
+    if numeric:
+        diff = np.empty(min(block_size, size))
+        limit = np.empty_like(diff)
+        close = np.empty(diff.shape, dtype=bool)
+    for start in range(0, size, block_size):
+        stop = min(start + block_size, size)
+        block, other_block = ref[start:stop], other[start:stop]
+        n = block.size
+        try:
+            if not numeric:
+                block_close = np.asarray(block == other_block)
+            else:
+                with np.errstate(invalid="ignore", over="ignore"):
+                    np.subtract(block, other_block, out=diff[:n], dtype=float)
+                    np.abs(diff[:n], out=diff[:n])
+                    np.abs(other_block, out=limit[:n], dtype=float)
+                    limit[:n] *= rtol
+                    limit[:n] += atol
+                    block_close = np.less_equal(diff[:n], limit[:n], out=close[:n])
+        except (TypeError, ValueError):
+            # e.g. dates compared to numbers
+            return start
+        if block_close.shape != (n,):
+            return start
+        if block_close.all():
+            continue
+        wrong = np.flatnonzero(~block_close)
+        if numeric:
+            # infinities are only close to themselves
+            values, other_values = block[wrong], other_block[wrong]
+            still_wrong = values != other_values
+            if equal_nan:
+                still_wrong &= ~(np.isnan(values) & np.isnan(other_values))
+            wrong = wrong[still_wrong]
+        if wrong.size:
+            return start + int(wrong[0])
+    if ref.size != other.size:
+        return size
+    return None
+
+def same_point_sets(x_data, y_data, other_x_data, other_y_data, tol=None):
+    """
+    Check if two sets of points are the same within a tolerance,
+    regardless of the order of the points in each set.
+
+    Both sets are sorted by x. Points whose x values are too close to
+    order reliably are then grouped, and each group is sorted by y, so
+    the two sets end up in the same order if they hold the same points.
+    """
+    x_data, y_data = np.asarray(x_data), np.asarray(y_data)
+    other_x_data, other_y_data = np.asarray(other_x_data), np.asarray(other_y_data)
+    if not (x_data.shape == y_data.shape == other_x_data.shape == other_y_data.shape):
+        return False
+    atol = _default_atol(tol)
+    order = np.argsort(x_data, kind="stable")
+    other_order = np.argsort(other_x_data, kind="stable")
+    x_data, y_data = x_data[order], y_data[order]
+    other_x_data, other_y_data = other_x_data[other_order], other_y_data[other_order]
+    gaps = np.diff(x_data) > 2 * (atol + 1e-5 * np.abs(x_data[1:]))
+    group = np.concatenate(([0], np.cumsum(gaps)))
+    order = np.lexsort((y_data, group))
+    other_order = np.lexsort((other_y_data, group))
+    return (first_difference(x_data[order], other_x_data[other_order], tol=atol) is None
+            and first_difference(y_data[order], other_y_data[other_order], tol=atol) is None)
+
+def _smallest(array, size=None, block_size=COMPARE_BLOCK_SIZE):
+    """
+    The `size` smallest elements of `array`, in order. The array is
+    read in blocks, so large (e.g. memory mapped) arrays aren't copied
+    """
+    size = _SORT_KEY_SIZE if size is None else size
+    array = np.ravel(array)
+    smallest = _sortable(array[:0])
+    for start in range(0, array.size, block_size):
+        block = np.concatenate((smallest, _sortable(array[start:start + block_size])))
+        if block.size > size:
+            block = np.partition(block, size - 1)[:size]
+        smallest = block
+    return np.sort(smallest)
+
+_SORT_KEY_SIZE = 16
+
+def _sortable(array):
+    """
+    Return `array` as a numpy array whose elements sort the same way
+    as python objects: dates become integers, and NaN sorts last
+    """
+    array = np.asarray(array)
+    if array.dtype.kind in "mM":
+        return array.astype(f"{array.dtype.kind}8[us]").view(np.int64)
+    if array.dtype.kind == "f":
+        return np.where(np.isnan(array), np.inf, array)
+    return array
+
+def _array_head(array, size=_SORT_KEY_SIZE):
+    """The first `size` elements of `array`, as a tuple"""
+    return tuple(_sortable(np.ravel(array)[:size]).tolist())
+
+def _array_tail(array, size=_SORT_KEY_SIZE):
+    """The last `size` elements of `array`, as a tuple"""
+    return tuple(_sortable(np.ravel(array)[-size:]).tolist())
+
+def _array_sum(array, block_size=COMPARE_BLOCK_SIZE):
+    """
+    The sum of the numeric elements of `array`, ignoring NaN and
+    infinities. Like `_smallest`, it works a block at a time
+    """
+    array = np.ravel(array)
+    if array.dtype.kind not in "biufmM":
+        return 0
+    total = 0.0
+    for start in range(0, array.size, block_size):
+        block = _sortable(array[start:start + block_size])
+        total += float(np.sum(block, where=np.isfinite(block)))
+    return total
+
 def numpy_array_gt(array1, array2):
     for i, j in zip(array1, array2):
         if i > j:
@@ -578,11 +3030,163 @@ def numpy_array_lt(array1, array2):
             return False
     return False
 
+class LineEnvelope:
+    """
+    Pyramid of the minimum and maximum of a long array in blocks, used to
+    compare very long lines without comparing every point.
+
+    Level 0 holds the minimum and maximum of each `block` elements of the
+    array, and each level above holds those of `fanout` blocks of the level
+    below. Arrays are compared coarse to fine, only looking at the blocks
+    within the blocks of the level above which differ. Arrays whose blocks
+    have similar minimums and maximums are taken to be similar, so a
+    difference which doesn't change them isn't found. A difference in the
+    minimums or maximums always means the arrays are different.
+    """
+    __slots__ = ("size", "block", "fanout", "mins", "maxs", "head", "tail", "sum")
+
+    def __init__(self, data, block=1024, fanout=16):
+        """
+        Parameters:
+            data (array_like): The numeric array, or a dictionary of the
+                attributes of an envelope
+            block (int): The number of elements in each block of level 0
+            fanout (int): The number of blocks in each block of the level above
+        """
+        if isinstance(data, dict):
+            for attr in self.__slots__:
+                setattr(self, attr, data[attr])
+            return
+        data = np.ravel(data)
+        self.size, self.block, self.fanout = data.size, block, fanout
+        # what Line.sort_key needs, so lines can be sorted without the data
+        self.head, self.tail, self.sum = (_array_head(data), _array_tail(data),
+                                          _array_sum(data))
+        self.mins, self.maxs = _envelope_levels(data, block, fanout)
+
+    def first_difference(self, data, other_data, other_envelope=None, tol=None,
+                         rtol=1e-5):
+        """
+        Like `first_difference(data, other_data)`, comparing the envelopes
+        and then the data, if it is known, of the first block which differs.
+
+        Parameters:
+            data (array_like): The data of this envelope, or None if it isn't known
+            other_data (array_like): The data to compare to, or None to compare
+                to `other_envelope` instead
+
+        Returns:
+            int or None: The index of the first difference (or the start of
+            the block it is in, if the data isn't known), or None if the
+            envelopes are similar
+        """
+        if other_data is not None:
+            other_data = np.ravel(other_data)
+            if other_data.size != self.size:
+                return min(other_data.size, self.size)
+            other_mins, other_maxs = _envelope_levels(other_data, self.block,
+                                                      self.fanout)
+        elif (other_envelope is None or other_envelope.size != self.size
+              or other_envelope.block != self.block
+              or other_envelope.fanout != self.fanout):
+            return 0
+        else:
+            other_mins, other_maxs = other_envelope.mins, other_envelope.maxs
+        block = self._first_block_difference(other_mins, other_maxs, tol, rtol)
+        if block is None:
+            return None
+        start = block * self.block
+        if data is not None and other_data is not None:
+            stop = start + self.block
+            index = first_difference(np.ravel(data)[start:stop], other_data[start:stop],
+                                     tol=tol, rtol=rtol)
+            if index is not None:
+                return start + index
+        return start
+
+    def _first_block_difference(self, other_mins, other_maxs, tol, rtol):
+        """The first block of level 0 whose minimum or maximum differs, or None"""
+        atol = _default_atol(tol)
+        blocks = np.arange(len(self.mins[-1]))
+        for level in range(len(self.mins) - 1, -1, -1):
+            mins, maxs = self.mins[level][blocks], self.maxs[level][blocks]
+            level_mins = other_mins[level][blocks]
+            level_maxs = other_maxs[level][blocks]
+            with np.errstate(invalid="ignore", over="ignore"):
+                # every element is within this of the other data, if the
+                # data are close
+                limit = atol + rtol * np.maximum(np.abs(level_mins), np.abs(level_maxs))
+                same = (((np.abs(mins - level_mins) <= limit) | (mins == level_mins))
+                        & ((np.abs(maxs - level_maxs) <= limit) | (maxs == level_maxs)))
+            blocks = blocks[~same]
+            if not blocks.size:
+                return None
+            if level:
+                blocks = (blocks[:, None] * self.fanout + np.arange(self.fanout)).ravel()
+                blocks = blocks[blocks < len(self.mins[level - 1])]
+        return int(blocks[0])
+
+    def _pack(self, arrays):
+        """Return the json-able header for the envelope, storing arrays in `arrays`"""
+        return {
+            "size": self.size, "block": self.block, "fanout": self.fanout,
+            "mins": [_store_array(arrays, mins) for mins in self.mins],
+            "maxs": [_store_array(arrays, maxs) for maxs in self.maxs],
+            "head": _store_array(arrays, np.array(self.head)),
+            "tail": _store_array(arrays, np.array(self.tail)),
+            "sum": self.sum,
+        }
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build an envelope from a header written by `_pack`"""
+        envelope = dict(meta)
+        envelope["mins"] = [_load_array(arrays, key) for key in meta["mins"]]
+        envelope["maxs"] = [_load_array(arrays, key) for key in meta["maxs"]]
+        envelope["head"] = tuple(_load_array(arrays, meta["head"]).tolist())
+        envelope["tail"] = tuple(_load_array(arrays, meta["tail"]).tolist())
+        return cls(envelope)
+
+def _envelope_levels(data, block, fanout):
+    """The minimums and maximums of each level of a `LineEnvelope` of `data`"""
+    mins, maxs = _block_reduce(data.astype(float, copy=False), block)
+    levels_mins, levels_maxs = [mins], [maxs]
+    while len(mins) > 1:
+        mins = _block_reduce(mins, fanout)[0]
+        maxs = _block_reduce(maxs, fanout)[1]
+        levels_mins.append(mins)
+        levels_maxs.append(maxs)
+    return levels_mins, levels_maxs
+
+def _block_reduce(array, block):
+    """The minimum and maximum of each `block` elements of `array`"""
+    if not array.size:
+        return array[:0], array[:0]
+    starts = np.arange(0, array.size, block)
+    return np.minimum.reduceat(array, starts), np.maximum.reduceat(array, starts)
+
 @total_ordering
 class Line:
     """Representation of a matplotlib line object"""
     all_attrs = ("x_data", "y_data", "linewidth",
                  "linestyle", "marker", "colour", "label")
+    # many lines may be held at once, so they don't each have a __dict__
+    __slots__ = all_attrs + ("envelopes", "_sort_key", "_digest")
+
+    @staticmethod
+    def _match_features(lines, attrs):
+        """The numbers and labels `_rematch` pairs lines by"""
+        values = np.array([np.concatenate(
+            [[np.size(line.x_data)]]
+            + [_sampled(getattr(line, attr)) for attr in ("x_data", "y_data")
+               if attr in attrs]
+            + [[line.linewidth] if "linewidth" in attrs else []])
+            for line in lines])
+        labels = np.array([[str(getattr(line, attr))
+                            for attr in ("linestyle", "marker", "colour", "label")
+                            if attr in attrs]
+                           for line in lines], dtype=str).reshape(len(lines), -1)
+        return values, labels
     def __init__(self, line):
         if isinstance(line, dict):
             # we need to create a line from a dictionary
@@ -593,6 +3197,7 @@ class Line:
             self.marker = line.get("marker", "")
             self.colour = line.get("colour", "")
             self.label = line.get("label", "")
+            self.envelopes = line.get("envelopes")
         else:
             # we probably have a matplotlib figure
             self.x_data = line.get_xdata()
@@ -607,6 +3212,9 @@ class Line:
             # set the label to an empty string
             if re.match(r"^_child[0-9]+$", self.label):
                 self.label = ""
+            self.envelopes = None
+        self._sort_key = None
+        self._digest = None
 
     def __repr__(self):
         rep = "Line({\n"
@@ -620,79 +3228,142 @@ class Line:
         rep += "        })"
         return rep
 
+    def _pack(self, arrays):
+        """Return the json-able header for the line, storing arrays in `arrays`"""
+        meta = {
+            "x_data": _store_array(arrays, self.x_data),
+            "y_data": _store_array(arrays, self.y_data),
+            "linewidth": float(self.linewidth),
+            "linestyle": self.linestyle,
+            "marker": _pack_marker(self.marker),
+            "colour": self.colour,
+            "label": self.label,
+        }
+        if self.envelopes:
+            meta["envelopes"] = {attr: envelope._pack(arrays)
+                                 for attr, envelope in self.envelopes.items()}
+        return meta
+
+    @classmethod
+    def _unpack(cls, meta, arrays):
+        """Build a line from a header written by `_pack`"""
+        line = dict(meta)
+        line["x_data"] = _load_array(arrays, meta["x_data"])
+        line["y_data"] = _load_array(arrays, meta["y_data"])
+        line["marker"] = _unpack_marker(meta.get("marker", ""))
+        if "envelopes" in meta:
+            line["envelopes"] = {attr: LineEnvelope._unpack(envelope, arrays)
+                                 for attr, envelope in meta["envelopes"].items()}
+        return cls(line)
+
+    def build_envelopes(self, block=1024, fanout=16, keep_data=True):
+        """
+        Build a `LineEnvelope` of the x and y data, so that the data of
+        other lines is compared to the envelopes rather than point by point.
+
+        Parameters:
+            block, fanout: As for `LineEnvelope`
+            keep_data (bool): If False, the data is dropped, so only the
+                envelopes are kept (and saved by `save_figures`)
+        """
+        self.envelopes = {}
+        for attr in ("x_data", "y_data"):
+            data = getattr(self, attr)
+            if data is None or np.asarray(data).dtype.kind not in "biuf":
+                continue
+            self.envelopes[attr] = LineEnvelope(data, block, fanout)
+            if not keep_data:
+                setattr(self, attr, None)
+                self._digest = None
+
+    def _summary(self, attr):
+        """The head, size, tail and sum of the x or y data, for sorting"""
+        data = getattr(self, attr)
+        if data is None and self.envelopes and attr in self.envelopes:
+            envelope = self.envelopes[attr]
+            return envelope.head, envelope.size, envelope.tail, envelope.sum
+        return _array_head(data), np.size(data), _array_tail(data), _array_sum(data)
+
     def __eq__(self, other):
         similar, _ = self.check_similar(other)
         return similar
 
+    @property
+    def sort_key(self):
+        """
+        Key which puts lines in a canonical order, so that the order lines
+        are plotted in doesn't matter. It is built once, with vectorised
+        numpy operations, from the start, length, end and sum of the data,
+        followed by the style of the line.
+        """
+        if self._sort_key is None:
+            x_head, x_size, x_tail, x_sum = self._summary("x_data")
+            y_head, y_size, y_tail, y_sum = self._summary("y_data")
+            self._sort_key = (x_head, y_head, x_size, y_size, x_tail, y_tail,
+                              x_sum, y_sum, self.label, self.colour, self.linewidth,
+                              self.linestyle,
+                              "" if self.marker is None else str(self.marker))
+        return self._sort_key
+
+    @property
+    def digest(self):
+        """Hex digest of the data and style of the line, computed once"""
+        if self._digest is None:
+            self._digest = _digest([getattr(self, attr) for attr in self.all_attrs])
+        return self._digest
+
     def __gt__(self, other):
-        if numpy_array_gt(self.x_data, other.x_data):
-            return True
-        if numpy_array_lt(self.x_data, other.x_data):
-            return False
-        if numpy_array_gt(self.y_data, other.y_data):
-            return True
-        if numpy_array_lt(self.y_data, other.y_data):
-            return False
-        if self.label > other.label:
-            return True
-        if self.label < other.label:
-            return False
-        if self.colour > other.colour:
-            return True
-        if self.colour < other.colour:
-            return False
-        if self.linewidth > other.linewidth:
-            return True
-        if self.linewidth < other.linewidth:
-            return False
-        if self.linestyle > other.linestyle:
-            return True
-        if self.linestyle < other.linestyle:
-            return False
-        if (self.marker is not None) and (other.marker is not None) and (self.marker > other.marker):
-            return True
-        if (self.marker is not None) and (other.marker is not None) and (self.marker < other.marker):
-            return False
-        return False
+        return self.sort_key > other.sort_key
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
 
     def check_similar(self, other, attrs=None, tol=None):
         """ Check if two lines are similar """
+        try:
+            self._diff(other, attrs, tol, _DiffReport(first_only=True))
+        except AssertionError as error:
+            return False, str(error)
+        return True, None
 
+    def _diff(self, other, attrs, tol, report, path=()):
+        """Add the differences between the lines to `report`"""
         test_attrs = self.all_attrs if not attrs else attrs
         # test all the attributes that relate to a line
         for attr in set(test_attrs).intersection(self.all_attrs):
             if attr in ("x_data", "y_data"):
                 # we have numeric data, so should test if close
-                # use a try except block to catch when allclose errors
-                # for example when the data are different lengths
-                data = getattr(self, attr)
-                try:
-                    if type(data) == np.ndarray and data.dtype == 'datetime64[us]':
-                        data_correct = np.all(data == getattr(other, attr))
-                    else:
-                        data_correct = np.allclose(
-                            data, getattr(other, attr), atol=tol
-                        )
-                except:
-                    data_correct = False
-
-                if not data_correct:
+                report.measure_error(attr, getattr(self, attr), getattr(other, attr))
+                if self.envelopes and attr in self.envelopes:
+                    index = self.envelopes[attr].first_difference(
+                        getattr(self, attr), getattr(other, attr),
+                        (other.envelopes or {}).get(attr), tol=tol)
+                else:
+                    index = first_difference(getattr(self, attr),
+                                             getattr(other, attr), tol=tol)
+                if index is not None:
                     msg  = f"A line (colour='{self.colour}', "
                     msg += f"label='{self.label}', "
                     msg += f"marker='{self.marker}', "
                     msg += f"linestyle='{self.linestyle}', "
                     msg += f"linewidth={self.linewidth}) "
                     msg +=  "isn't where it should be\n"
+                    msg += f"First difference in {attr} at index {index}\n"
                     msg += f"Expected {attr}: {getattr(self, attr)}\n"
                     msg += f"But got {getattr(other, attr)}\n"
-                    return False, msg
+                    report.add(path, attr, getattr(self, attr),
+                               getattr(other, attr), msg,
+                               error=lambda: _max_abs_error(getattr(self, attr),
+                                                            getattr(other, attr)))
             else:
                 # we have non numeric data, so can test exactly
                 if getattr(self, attr) != getattr(other, attr):
                     msg = f"Incorrect {attr}, '{getattr(other, attr)}'."
                     msg += f"Expected '{getattr(self, attr)}'"
-                    return False, msg
-        return True, None
+                    report.add(path, attr, getattr(self, attr),
+                               getattr(other, attr), msg,
+                               error=lambda: _max_abs_error(getattr(self, attr),
+                                                            getattr(other, attr)))
 
     def assert_similar(self, other, attrs=None, tol=None):
         """Assert that the line is similar to another line"""
@@ -703,6 +3374,97 @@ class Line:
             raise AssertionError(msg)
 
 
+# the attributes `score_figures` can score
+SCORED_ATTRS = frozenset(Figure.all_attrs + Axis.all_attrs + Line.all_attrs
+                         + PathCollection.all_attrs + PatchArray.all_attrs)
+
+
+class TextValue(namedtuple("TextValue", ("x", "y", "text", "size"))):
+    """
+    The position, string and font size of a piece of text, which is all that
+    is compared of a matplotlib.text.Text. It has the same getters as Text.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_text(cls, text):
+        """Make a TextValue from a matplotlib.text.Text (or TextValue, or None)"""
+        if text is None or isinstance(text, TextValue):
+            return text
+        x, y = text.get_position()
+        return cls(float(x), float(y), text.get_text(), float(text.get_size()))
+
+    def get_position(self):
+        return self.x, self.y
+
+    def get_text(self):
+        return self.text
+
+    def get_size(self):
+        return self.size
+
+class TextList:
+    """
+    A list of texts (or None), such as the tick labels of an axis, stored as
+    an array of positions, an array of strings and an array of font sizes so
+    that whole lists can be compared at once.
+    """
+    __slots__ = ("positions", "texts", "sizes", "present")
+
+    def __init__(self, texts=()):
+        """
+        Parameters:
+            texts (Iterable): matplotlib.text.Text objects, `TextValue`s or None
+        """
+        values = [TextValue.from_text(text) for text in texts]
+        self.present = np.array([value is not None for value in values], dtype=bool)
+        values = [value if value is not None else (np.nan, np.nan, "", np.nan)
+                  for value in values]
+        self.positions = np.array([value[:2] for value in values],
+                                  dtype=np.float64).reshape(-1, 2)
+        self.texts = np.array([value[2] for value in values], dtype=str)
+        self.sizes = np.array([value[3] for value in values], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, index):
+        if not self.present[index]:
+            return None
+        x, y = self.positions[index]
+        return TextValue(float(x), float(y), str(self.texts[index]),
+                         float(self.sizes[index]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        return f"TextList({list(self)!r})"
+
+    def first_difference(self, other):
+        """
+        Index of the first text which differs from the text at the same index
+        in `other`, comparing as many texts as the shorter list has. Returns
+        None if they are all the same.
+        """
+        size = min(len(self), len(other))
+        present, other_present = self.present[:size], other.present[:size]
+        same = ((self.positions[:size] == other.positions[:size]).all(axis=1)
+                & (self.texts[:size] == other.texts[:size])
+                & (self.sizes[:size] == other.sizes[:size]))
+        same = (present == other_present) & (~present | same)
+        different = np.flatnonzero(~same)
+        return int(different[0]) if different.size else None
+
+    def _pack(self):
+        """Return a json-able version of the texts"""
+        return [None if text is None else list(text) for text in self]
+
+    @classmethod
+    def _unpack(cls, meta):
+        """Build the list from a header written by `_pack`"""
+        return cls(None if text is None else TextValue(*text) for text in meta)
+
 def check_text_equal(text, ref_text, tol=None):
     """Check if two matplotlib.text.Text objects are equal"""
     if text is None and ref_text is None:
@@ -718,3 +3480,179 @@ def check_text_equal(text, ref_text, tol=None):
     if text.get_size() != ref_text.get_size():
         return False
     return True
+
+
+def _digest(*values):
+    """Hex digest of some values, which may be nested lists of values"""
+    hasher = hashlib.blake2b(digest_size=16)
+    _update_digest(hasher, values)
+    return hasher.hexdigest()
+
+def _has_nan(array):
+    """Whether a float array holds NaN, or a date or time array NaT"""
+    if array is None:
+        return False
+    array = np.asarray(array)
+    if not array.size:
+        return False
+    # the minimum is NaN (or NaT) if any element is, without making a mask
+    if array.dtype.kind == "f":
+        return bool(np.isnan(array.min()))
+    if array.dtype.kind in "mM":
+        return bool(np.isnat(array.min()))
+    return False
+
+def _update_digest(hasher, value):
+    """
+    Add a value to a digest. Each value is tagged with its type (and length),
+    so that different values can't produce the same stream of bytes, and
+    numbers are canonicalised, so that e.g. the integer 1 and the float 1.0
+    (which compare equal) have the same digest. Integers a float can't hold
+    exactly are kept as integers, so they can't share a digest.
+    """
+    if value is None:
+        hasher.update(b"N")
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        hasher.update(b"s%d:" % len(data) + data)
+    elif isinstance(value, (bool, np.bool_)):
+        hasher.update(b"T" if value else b"F")
+    elif isinstance(value, numbers.Integral) and float(int(value)) != int(value):
+        hasher.update(b"i%d" % int(value))
+    elif isinstance(value, numbers.Real):
+        hasher.update(b"f" + repr(float(value)).encode())
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"(%d:" % len(value))
+        for item in value:
+            _update_digest(hasher, item)
+    elif isinstance(value, Text):
+        _update_digest(hasher, _pack_text(value))
+    elif isinstance(value, TextList):
+        _update_digest(hasher, value._pack())
+    elif isinstance(value, Path):
+        _update_digest(hasher, (value.vertices, value.codes))
+    elif isinstance(value, dict):
+        hasher.update(b"{%d:" % len(value))
+        for key, item in sorted(value.items(), key=lambda item: repr(item[0])):
+            _update_digest(hasher, (key, item))
+    else:
+        try:
+            array = np.asarray(value)
+        except (TypeError, ValueError):
+            # e.g. an object which fails to convert itself to an array
+            hasher.update(b"r" + repr(value).encode())
+            return
+        if array.dtype.kind in "iu" and array.dtype.itemsize >= 8 and array.size:
+            # int64 values above 2**53 can't be held exactly by a float64
+            if max(abs(int(array.min())), abs(int(array.max()))) <= 2 ** 53:
+                array = array.astype(np.float64)
+        elif array.dtype.kind in "biu" or (array.dtype.kind == "f"
+                                           and array.dtype.itemsize <= 8):
+            array = array.astype(np.float64)
+        array = np.ascontiguousarray(array)
+        hasher.update(b"a%s%s:" % (array.dtype.str.encode(), repr(array.shape).encode()))
+        if array.dtype.kind == "O":
+            hasher.update(repr(array.tolist()).encode())
+        elif array.dtype.kind in "mM":
+            # dates and times can't be viewed as a buffer, but their unit is
+            # in the dtype hashed above
+            hasher.update(array.view(np.int64).data)
+        else:
+            hasher.update(array.data)
+
+def _store_array(arrays, array):
+    """Add `array` to the dictionary of arrays to save, returning its key"""
+    if array is None:
+        return None
+    key = f"arr_{len(arrays)}"
+    arrays[key] = _storable_array(array)
+    return key
+
+def _storable_array(array):
+    """
+    `array` as an array which can be saved without pickling it. Arrays of
+    python objects, e.g. the `datetime`s a line was plotted against, are
+    converted to arrays of `datetime64`, numbers or strings.
+
+    Raises:
+        ValueError: If the array holds objects which can't be converted
+    """
+    array = np.asarray(array)
+    if array.dtype != object:
+        return array
+    with warnings.catch_warnings():
+        # numpy only warns that it drops the time zone of a datetime
+        warnings.simplefilter("error")
+        if array.size and all(isinstance(value, (datetime.date, np.datetime64))
+               for value in array.flat):
+            try:
+                return array.astype("datetime64[us]")
+            except (TypeError, ValueError, UserWarning):
+                pass
+        try:
+            converted = np.asarray(array.tolist())
+        except (TypeError, ValueError, UserWarning):
+            converted = array
+    numeric = converted.dtype.kind in "biufc"
+    strings = (converted.dtype.kind == "U"
+               and all(isinstance(value, str) for value in array.flat))
+    if not (numeric or strings) or converted.shape != array.shape:
+        kinds = sorted({type(value).__name__ for value in array.flat})
+        raise ValueError(f"Can't save an array of {', '.join(kinds)} objects "
+                         f"in a reference file")
+    return converted
+
+def _load_array(arrays, key):
+    """Get an array saved with `_store_array`"""
+    if key is None:
+        return None
+    return arrays[key]
+
+def _pack_text(text):
+    """Return a json-able version of a matplotlib.text.Text or `TextValue`"""
+    if text is None:
+        return None
+    return list(TextValue.from_text(text))
+
+def _unpack_text(meta):
+    """Rebuild a `TextValue` packed with `_pack_text`"""
+    if meta is None:
+        return None
+    return TextValue(*meta)
+
+def _pack_marker(marker):
+    """
+    Return a json-able version of the marker of a line. Tuples, e.g.
+    (5, 0, 0) for a pentagon, are tagged, so they aren't read back as lists.
+
+    Raises:
+        ValueError: If the marker isn't a string, number or tuple of them,
+            e.g. a `Path`
+    """
+    if marker is None or isinstance(marker, str):
+        return marker
+    if isinstance(marker, (bool, np.bool_)):
+        return bool(marker)
+    if isinstance(marker, numbers.Integral):
+        return int(marker)
+    if isinstance(marker, numbers.Real):
+        return float(marker)
+    if isinstance(marker, tuple):
+        return {"tuple": [_pack_marker(item) for item in marker]}
+    raise ValueError(f"Can't save a marker of {type(marker).__name__} objects "
+                     f"in a reference file")
+
+def _unpack_marker(meta):
+    """Rebuild a marker packed with `_pack_marker`"""
+    if isinstance(meta, dict):
+        return tuple(_unpack_marker(item) for item in meta["tuple"])
+    if isinstance(meta, list):
+        # written untagged by earlier versions
+        return tuple(_unpack_marker(item) for item in meta)
+    return meta
+
+def _as_text_list(texts):
+    """Make a `TextList` from a list of texts, as in older reference files"""
+    if isinstance(texts, TextList):
+        return texts
+    return TextList(texts or ())
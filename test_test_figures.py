@@ -1,5 +1,25 @@
+import gc
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from matplotlib import pyplot as plt
-from test_figures import assert_similar_figures, capture_figures, Figure
+from matplotlib.text import Text
+import test_figures
+from test_figures import (assert_similar_figures, capture_figures, Figure,
+                          FigureOutput, load_figures, first_difference,
+                          grade_batch, capture_figures_sandboxed, ResultStore,
+                          isolated_figures, capture_figure_data, no_render,
+                          CaptureError, CaptureTimeout, profile_figures,
+                          ReferenceCache, TextList, TextValue,
+                          StreamingFigureOutput, export_columnar,
+                          load_columnar, diff_figures, score_figures,
+                          save_figures)
 from test_test_figures_runner import run_tests, register_test
 from test_data.test_figure_repr import test_hist
 
@@ -97,6 +117,40 @@ def test_bar_dissimilar():
 
     assert_similar_figures(fig, fig2)
 
+@register_test()
+def test_hist_many_bins_similar():
+    plt.close("all")
+    data = np.random.default_rng(0).normal(size=10000)
+    fig, ax = plt.subplots()
+    ax.hist(data, bins=2000)
+
+    fig2, ax2 = plt.subplots()
+    ax2.hist(data[::-1], bins=2000)
+
+    assert_similar_figures(fig, fig2)
+
+@register_test()
+def test_bar_within_tol():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.bar([1, 2, 3], [5, 8, 1])
+
+    fig2, ax2 = plt.subplots()
+    ax2.bar([1, 2, 3], [5, 8.001, 1])
+
+    assert_similar_figures(fig, fig2, tol=1e-2)
+
+@register_test(should_fail=True)
+def test_bar_outside_tol():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.bar([1, 2, 3], [5, 8, 1])
+
+    fig2, ax2 = plt.subplots()
+    ax2.bar([1, 2, 3], [5, 8.1, 1])
+
+    assert_similar_figures(fig, fig2, tol=1e-2)
+
 @register_test()
 def test_scatter_similar():
     plt.close("all")
@@ -123,6 +177,88 @@ def test_scatter_dissimilar():
 
     assert_similar_figures(fig, fig2)
 
+@register_test()
+def test_scatter_unordered_similar():
+    plt.close("all")
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 10, 1000).astype(float)
+    y = rng.normal(size=1000)
+    order = rng.permutation(1000)
+    fig, ax = plt.subplots()
+    ax.scatter(x, y)
+
+    fig2, ax2 = plt.subplots()
+    ax2.scatter(x[order] + 1e-7, y[order])
+
+    assert_similar_figures(fig, fig2, ordered_scatter=False)
+
+@register_test(should_fail=True)
+def test_scatter_unordered_ordered_dissimilar():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.scatter([1,2,3,4], [7,4,2,6])
+
+    fig2, ax2 = plt.subplots()
+    ax2.scatter([4,3,2,1], [6,2,4,7])
+
+    assert_similar_figures(fig, fig2)
+
+@register_test(should_fail=True)
+def test_scatter_unordered_dissimilar():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.scatter([1,1,3,4], [7,4,2,6])
+
+    fig2, ax2 = plt.subplots()
+    ax2.scatter([4,3,1,1], [6,2,7,5])
+
+    assert_similar_figures(fig, fig2, ordered_scatter=False)
+
+@register_test()
+def test_lazy_extraction():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1,2,3,4], [6,2,5,2])
+    fig2, ax2 = plt.subplots()
+    ax2.plot([1,2,3,4], [6,2,5,2])
+
+    ref, other = Figure(fig), Figure(fig2)
+    assert_similar_figures(ref, other, ("x_data", "y_data"))
+    assert "xtick_label" not in vars(other.axes[0])
+    assert "lines" in vars(other.axes[0])
+
+    other.extract()
+    ax2.set_title("Changed after extraction")
+    assert other.axes[0].title == ""
+
+@register_test()
+def test_first_difference():
+    ref = np.linspace(0, 1, 100000)
+    other = ref.copy()
+    other[70000] += 1e-3
+    assert first_difference(ref, ref + 1e-9, block_size=1000) is None
+    assert first_difference(ref, other, block_size=1000) == 70000
+    assert first_difference(ref, other[:500], block_size=1000) == 500
+    assert first_difference([1, np.inf], [1, np.inf]) is None
+    assert first_difference([1, np.nan], [1, np.nan]) == 1
+    dates = np.arange("2020-01-01", "2020-01-05", dtype="datetime64[D]")
+    assert first_difference(dates, dates) is None
+    assert first_difference(dates, dates + 1) == 0
+
+@register_test(should_fail=True)
+def test_line_late_difference():
+    plt.close("all")
+    x = np.arange(50000)
+    fig, ax = plt.subplots()
+    ax.plot(x, np.sin(x))
+
+    fig2, ax2 = plt.subplots()
+    y = np.sin(x)
+    y[-1] += 1
+    ax2.plot(x, y)
+
+    assert_similar_figures(fig, fig2)
+
 def plot_data(data1, data2):
     fig1, ax1 = plt.subplots()
     ax1.plot(data1[0], data1[1])
@@ -203,6 +339,866 @@ def test_sharex_fail():
 
     assert_similar_figures(fig, fig2)
 
+@register_test()
+def test_binary_reference_round_trip():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    x = np.linspace(0, 1, 5000)
+    ax.plot(x, np.sin(x) + 1e-9 * np.arange(x.size), c='r', label="sin")
+    ax.scatter([1, 2, 3], [4, 5, 6])
+    ax.bar([1, 2, 3], [7, 6, 8])
+    ax.legend()
+    fig.supxlabel("x")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        with FigureOutput(file_name) as output:
+            output.write_to_file(fig, "test_fig")
+        ref = Figure.load(file_name)
+        assert list(load_figures(file_name)) == ["test_fig"]
+
+    assert np.array_equal(ref.axes[0].lines[0].y_data, ax.lines[0].get_ydata())
+    assert_similar_figures(ref, fig, tol=0)
+
+@register_test(should_fail=True)
+def test_binary_reference_dissimilar():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot(np.arange(2000), np.arange(2000))
+
+    fig2, ax2 = plt.subplots()
+    y = np.arange(2000.0)
+    y[1500] += 1
+    ax2.plot(np.arange(2000), y)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        with FigureOutput(file_name) as output:
+            output.write_to_file(fig, "test_fig")
+        ref = Figure.load(file_name, "test_fig")
+
+    assert_similar_figures(ref, fig2)
+
+@register_test()
+def test_binary_reference_mmap():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot(np.arange(3000), np.arange(3000) ** 2)
+    ax.plot([], [])
+    ax.scatter([1, 2], [3, 4])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        with FigureOutput(file_name) as output:
+            output.write_to_file(fig, "test_fig")
+        ref = Figure.load(file_name, mmap=True)
+        y_data = ref.axes[0].lines[0].y_data
+        assert isinstance(y_data.base, np.memmap)
+        assert not y_data.flags.writeable
+        assert_similar_figures(ref, fig)
+        del ref, y_data
+
+    # a reference with many arrays is mapped once, not once per array
+    fig, ax = plt.subplots()
+    for i in range(600):
+        ax.plot([1, 2, 3], [i, i + 1, i + 2])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        save_figures(file_name, {"test_fig": fig})
+        fds = "/proc/self/fd"
+        open_files = len(os.listdir(fds)) if os.path.isdir(fds) else None
+        ref = Figure.load(file_name, mmap=True)
+        if open_files is not None:
+            assert len(os.listdir(fds)) <= open_files + 2
+        assert_similar_figures(ref, fig, ("x_data", "y_data"))
+        del ref
+
+@register_test()
+def test_sort_keys_dont_copy():
+    import tracemalloc
+    data = np.linspace(0, 1, 10 ** 6)
+    data[::7] = np.nan
+    data[5] = np.inf
+    tracemalloc.start()
+    try:
+        smallest = test_figures._smallest(data)
+        total = test_figures._array_sum(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # the keys are worked out a block at a time, so a large (memory
+    # mapped) array isn't copied just to sort it
+    assert peak < data.nbytes / 10
+    finite = data[np.isfinite(data)]
+    assert np.array_equal(smallest, np.sort(finite)[:len(smallest)])
+    assert np.isclose(total, np.sum(finite))
+    assert np.isinf(test_figures._smallest([np.nan, 1.0], 2)[-1])
+
+@register_test()
+def test_binary_reference_object_arrays():
+    import datetime
+    plt.close("all")
+    fig, ax = plt.subplots()
+    dates = [datetime.datetime(2020, 1, day) for day in (1, 2, 3)]
+    ax.plot(dates, [1, 2, 3])
+    assert ax.lines[0].get_xdata().dtype == object
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        save_figures(file_name, {"test_fig": fig})
+        for mmap in (False, True):
+            ref = load_figures(file_name, mmap=mmap)["test_fig"]
+            assert ref.axes[0].lines[0].x_data.dtype.kind == "M"
+            assert_similar_figures(ref, fig)
+        del ref
+
+        # objects which can't be saved without pickling are refused, rather
+        # than writing a file which can't be loaded
+        ax.lines[0].set_xdata(np.array([1, "a", None], dtype=object))
+        other_file = os.path.join(tmp_dir, "other.npz")
+        try:
+            save_figures(other_file, {"test_fig": fig})
+        except ValueError as err:
+            assert "Can't save" in str(err)
+        else:
+            raise AssertionError("Object arrays should be refused")
+        assert not os.path.exists(other_file)
+
+@register_test()
+def test_binary_reference_markers():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    for i, marker in enumerate([(5, 0, 0), (4, 1, 45.5), 3, "$x$", "o"]):
+        ax.plot([1, 2, 3], [i, i, i], marker=marker)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ref.npz")
+        save_figures(file_name, {"test_fig": fig})
+        ref = load_figures(file_name)["test_fig"]
+        assert sorted(map(repr, (line.marker for line in ref.axes[0].lines))) == \
+            sorted(map(repr, [(5, 0, 0), (4, 1, 45.5), 3, "$x$", "o"]))
+        assert_similar_figures(ref, fig)
+
+        # markers which can't be stored are refused
+        ax.plot([1, 2], [3, 4], marker=test_figures.Path([[0, 0], [1, 1]]))
+        try:
+            save_figures(os.path.join(tmp_dir, "other.npz"), {"test_fig": fig})
+        except ValueError as err:
+            assert "Can't save a marker" in str(err)
+        else:
+            raise AssertionError("Path markers should be refused")
+
+@register_test()
+def test_line_order_same_start():
+    plt.close("all")
+    x = np.arange(100)
+    y1 = np.zeros(100)
+    y2 = np.zeros(100)
+    y2[60:] = 1
+    fig, ax = plt.subplots()
+    ax.plot(x, y1, c='k')
+    ax.plot(x, y2, c='k')
+
+    fig2, ax2 = plt.subplots()
+    ax2.plot(x, y2, c='k')
+    ax2.plot(x, y1, c='k')
+
+    assert_similar_figures(fig, fig2)
+
+def plot_line(y_data):
+    plt.figure()
+    plt.plot([1, 2, 3], y_data)
+
+def plot_nothing():
+    pass
+
+def plot_error():
+    raise ValueError("Student error")
+
+def plot_exit():
+    plot_line([4, 5, 6])
+    sys.exit("Student exit")
+
+def plot_and_save(file_name):
+    plot_line([4, 5, 6])
+    plt.savefig(file_name)
+    assert os.path.getsize(file_name) > 0
+
+@register_test()
+def test_grade_batch():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    submissions = [(plot_line, ([4, 5, 6],)), (plot_line, ([4, 5, 7],)),
+                   plot_nothing, plot_error]
+    for workers in (1, 2):
+        results = grade_batch(fig, submissions, attrs=("x_data", "y_data"),
+                              workers=workers)
+        assert [result.passed for result in results] == [True, False, False, False]
+        assert [result.error for result in results] == [False, False, False, True]
+        assert "Incorrect number of figures" in results[2].message
+        assert "Student error" in results[3].message
+
+    # a submission which exits doesn't stop the others being graded
+    for workers, threads in ((1, False), (2, False), (2, True)):
+        results = grade_batch(fig, [plot_exit, (plot_line, ([4, 5, 6],))],
+                              workers=workers, threads=threads)
+        assert [result.passed for result in results] == [False, True]
+        assert results[0].error and "SystemExit" in results[0].message
+
+    # saving a figure writes nothing, unless rendering
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        submission = (plot_and_save, (os.path.join(tmp_dir, "out.png"),))
+        results = grade_batch(fig, [submission], workers=1)
+        assert results[0].error and "FileNotFoundError" in results[0].message
+        for timeout in (None, 60):
+            results = grade_batch(fig, [submission], workers=1, render=True,
+                                  timeout=timeout)
+            assert results[0].passed, results[0].message
+
+def plot_forever():
+    plt.figure()
+    while True:
+        pass
+
+def plot_huge():
+    plt.figure()
+    plt.plot(np.ones(10**10))
+
+@register_test()
+def test_capture_sandboxed():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    figs, _ = capture_figures_sandboxed(plot_line, ([4, 5, 6],), timeout=30)
+    assert isinstance(figs[0], Figure)
+    assert_similar_figures(fig, figs[0], ("x_data", "y_data"))
+
+    for func, kwargs, error in ((plot_forever, {"timeout": 1}, CaptureTimeout),
+                                (plot_huge, {"memory_limit": 2**31}, CaptureError),
+                                (plot_error, {}, CaptureError)):
+        try:
+            capture_figures_sandboxed(func, **kwargs)
+        except error:
+            pass
+        else:
+            raise AssertionError(f"{func.__name__} didn't raise {error.__name__}")
+
+    results = grade_batch(fig, [plot_forever, (plot_line, ([4, 5, 6],))],
+                          attrs=("y_data",), workers=1, timeout=1)
+    assert results[0].error and "didn't finish" in results[0].message
+    assert results[1].passed
+
+@register_test()
+def test_profile_figures():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    ax.plot([1, 2, 3], [6, 5, 4])
+    ax.bar([1, 2], [3, 4])
+    calls = []
+    with profile_figures(callback=lambda *args: calls.append(args)) as profile:
+        capture_figures(plot_line, [4, 5, 6])
+        assert_similar_figures(fig, fig)
+    stats = profile.as_dict()
+    assert stats["capture"]["figure"]["calls"] == 1
+    assert stats["compare"]["line"]["calls"] == 2
+    assert stats["compare"]["line"]["elements"] == 12
+    assert stats["extract"]["patch"]["calls"] == 4
+    assert stats["compare"]["text"]["calls"] > 0
+    assert len(calls) > 0
+    assert "compare" in profile.report()
+
+@register_test()
+def test_reference_cache():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    cache = ReferenceCache(maxsize=2)
+    repr_file = os.path.join(os.path.dirname(__file__), "test_data",
+                             "test_figure_repr.py")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_names = [os.path.join(tmp_dir, f"ref{i}.npz") for i in range(2)]
+        for file_name in file_names:
+            with FigureOutput(file_name) as output:
+                output.write_to_file(fig, "test_fig")
+
+        figs = cache.load(file_names[0])
+        assert cache.load(file_names[0]) is figs
+        assert_similar_figures(figs["test_fig"], fig)
+
+        # a changed file is loaded again
+        stat = os.stat(file_names[0])
+        os.utime(file_names[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert cache.load(file_names[0]) is not figs
+        assert len(cache) == 1
+
+        # the least recently used file is dropped
+        figs = cache.load(file_names[0])
+        cache.load(file_names[1])
+        assert list(cache.load(repr_file)) == ["test_hist"]
+        assert len(cache) == 2
+        assert cache.load(file_names[0]) is not figs
+
+@register_test()
+def test_figure_digest():
+    plt.close("all")
+    figs = []
+    for _ in range(2):
+        fig, ax = plt.subplots()
+        ax.plot([1, 2, 3], [4, 5, 6], c='r')
+        ax.plot([1.0, 2.0, 3.0], [6, 5, 4], c='k')
+        ax.scatter([1, 2], [3, 4])
+        ax.bar([1, 2], [3, 4])
+        figs.append(fig)
+    figs[1].axes[0].lines[1].set_ydata([6, 5, 4.5])
+
+    ref, same, different = Figure(figs[0]), Figure(figs[0]), Figure(figs[1])
+    assert ref.digest == same.digest
+    assert ref.digest != different.digest
+    assert ref.axes[0].patches.digest == different.axes[0].patches.digest
+    assert ref.axes[0].lines[0].digest == different.axes[0].lines[0].digest
+
+    results = grade_batch(figs[0], [(plot_line, ([4, 5, 6],)),
+                                    (plot_line, ([4, 5, 6],)),
+                                    (plot_line, ([4, 5, 7],))],
+                          attrs=("y_data",), workers=1, fingerprint=True)
+    assert results[0].digest == results[1].digest != results[2].digest
+
+    # NaN isn't close to NaN, so identical figures holding it aren't
+    # similar, whether or not their digests are known
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, np.nan, 6])
+    for known_digests in (False, True):
+        ref, same = Figure(fig).extract(), Figure(fig).extract()
+        if known_digests:
+            assert ref.digest == same.digest
+        try:
+            assert_similar_figures(ref, same)
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("Lines holding NaN shouldn't be similar")
+
+    # integers a float can't hold exactly still have different digests
+    assert test_figures._digest(np.array([2 ** 53, 1])) != \
+        test_figures._digest(np.array([2 ** 53 + 1, 1]))
+    assert test_figures._digest(2 ** 53) != test_figures._digest(2 ** 53 + 1)
+    assert test_figures._digest(np.array([1, 2])) == \
+        test_figures._digest(np.array([1.0, 2.0]))
+
+    # dates, e.g. as a reference file stores them
+    dates = np.array(["2020-01-01", "2020-01-02"], dtype="datetime64[us]")
+    assert test_figures._digest(dates) == test_figures._digest(dates.copy())
+    assert test_figures._digest(dates) != test_figures._digest(dates + 1)
+    assert test_figures._digest(dates) != \
+        test_figures._digest(dates.astype("datetime64[ms]"))
+    fig, ax = plt.subplots()
+    ax.plot(dates, [1, 2])
+    results = grade_batch(fig, [(plot_dates, (dates,)), (plot_dates, (dates,))],
+                          workers=1, fingerprint=True)
+    assert [result.passed for result in results] == [True, True]
+    assert results[0].digest == results[1].digest
+
+    # NaT is like NaN
+    ax.lines[0].set_xdata(np.array(["2020-01-01", "NaT"], dtype="datetime64[us]"))
+    ref, same = Figure(fig).extract(), Figure(fig).extract()
+    assert ref.digest == same.digest
+    try:
+        assert_similar_figures(ref, same)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("Lines holding NaT shouldn't be similar")
+
+def plot_dates(dates):
+    plt.figure()
+    plt.plot(dates, [1, 2])
+
+plot_calls = []
+
+def plot_line_counted(y_data):
+    plot_calls.append(y_data)
+    plot_line(y_data)
+
+@register_test()
+def test_result_store():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    submissions = [(plot_line_counted, ([4, 5, 6],)),
+                   (plot_line_counted, ([4, 5, 7],)), plot_error]
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ResultStore(os.path.join(tmp_dir, "results.db")) as store:
+        del plot_calls[:]
+        first = grade_batch(fig, submissions, attrs=("y_data",), workers=1,
+                            store=store)
+        assert len(plot_calls) == 2 and len(store) == 3
+        again = grade_batch(fig, submissions, attrs=("y_data",), workers=1,
+                            store=store)
+        assert again == first and len(plot_calls) == 2
+
+        # a new reference is compared to the figures kept, without running
+        # the submissions again
+        ax.lines[0].set_ydata([4, 5, 7])
+        new = grade_batch(Figure(fig), submissions, attrs=("y_data",),
+                          workers=1, store=store)
+        assert [result.passed for result in new] == [False, True, False]
+        assert new[2].error and "Student error" in new[2].message
+        assert len(plot_calls) == 2 and len(store) == 6
+
+        # figures kept which can't be read are captured again
+        with store._connection:
+            store._connection.execute("UPDATE captures SET figures = ? "
+                                      "WHERE figures IS NOT NULL",
+                                      (b"not a reference file",))
+        new = grade_batch(Figure(fig), submissions, attrs=("x_data", "y_data"),
+                          workers=1, store=store)
+        assert [result.passed for result in new] == [False, True, False]
+        assert len(plot_calls) == 4
+        new = grade_batch(Figure(fig), submissions, attrs=("y_data", "colour"),
+                          workers=1, store=store)
+        assert [result.passed for result in new] == [False, True, False]
+        assert len(plot_calls) == 4
+
+    # large arrays which only differ in the middle are different submissions
+    y_data = np.zeros(2000)
+    other_y_data = y_data.copy()
+    other_y_data[1000] = 1
+    assert (test_figures.submission_hash((plot_line, (y_data,)))
+            == test_figures.submission_hash((plot_line, (y_data.copy(),))))
+    assert (test_figures.submission_hash((plot_line, (y_data,)))
+            != test_figures.submission_hash((plot_line, (other_y_data,))))
+    assert (test_figures.submission_hash((plot_line, (), {"y_data": y_data}))
+            != test_figures.submission_hash((plot_line, (), {"y_data": other_y_data})))
+
+    # functions passed as arguments are hashed by their name and source, so
+    # the hash is the same in another run
+    submission = (first_difference, (test_figures.same_point_sets, [4, 5, 6]))
+    assert (test_figures.submission_hash(submission)
+            != test_figures.submission_hash((first_difference,
+                                             (test_figures.check_text_equal, [4, 5, 6]))))
+    code = ("from test_figures import *; print(submission_hash("
+            "(first_difference, (same_point_sets, [4, 5, 6]))))")
+    other_run = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                               text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert other_run.stdout.strip() == test_figures.submission_hash(submission)
+    # and arguments whose repr changes from run to run are refused
+    try:
+        test_figures.submission_hash((plot_data, (object(), [4, 5, 6])))
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("An argument with an address in its repr should be refused")
+
+def plot_line_slowly(y_data):
+    plt.figure()
+    time.sleep(0.05)
+    plt.plot([1, 2, 3], y_data)
+    time.sleep(0.05)
+    plt.gcf().suptitle(str(y_data))
+
+@register_test()
+def test_capture_in_threads():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    y_datas = [[4, 5, i] for i in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        captures = list(executor.map(
+            lambda y_data: capture_figures(plot_line_slowly, y_data), y_datas))
+    for y_data, (figs, _) in zip(y_datas, captures):
+        assert len(figs) == 1
+        assert list(figs[0].axes[0].lines[0].get_ydata()) == y_data
+        assert figs[0].get_suptitle() == str(y_data)
+    # the figures made before are left alone
+    assert plt.gcf() is fig and plt.get_fignums() == [fig.number]
+
+    with isolated_figures():
+        assert plt.get_fignums() == []
+        plt.figure()
+        assert len(plt.get_fignums()) == 1
+    assert plt.gcf() is fig
+
+    results = grade_batch(fig, [(plot_line_slowly, (y_data,)) for y_data in y_datas],
+                          attrs=("y_data",), workers=4, threads=True)
+    assert [result.passed for result in results] == [i == 6 for i in range(8)]
+
+made_figures = []
+
+def plot_line_tracked(y_data):
+    plot_line(y_data)
+    plt.legend(["data"])
+    made_figures.append(weakref.ref(plt.gcf()))
+
+@register_test()
+def test_capture_figure_data():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    ax.legend(["data"])
+    del made_figures[:]
+    figs, _ = capture_figure_data(plot_line_tracked, [4, 5, 6])
+    assert len(figs) == 1 and isinstance(figs[0], Figure)
+    assert_similar_figures(fig, figs[0])
+    # nothing refers to the matplotlib figure any more
+    gc.collect()
+    assert made_figures[0]() is None
+    assert plt.get_fignums() == [fig.number]
+
+    try:
+        capture_figure_data(plot_error)
+    except CaptureError:
+        pass
+    else:
+        raise AssertionError("capture_figure_data didn't raise CaptureError")
+
+def plot_and_show(file_name):
+    plot_line([4, 5, 6])
+    plt.savefig(file_name)
+    plt.gcf().canvas.draw()
+    plt.pause(2)
+    plt.show()
+
+@register_test()
+def test_no_render():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "fig.png")
+        start = time.perf_counter()
+        with no_render():
+            figs, _ = capture_figure_data(plot_and_show, file_name)
+        assert time.perf_counter() - start < 2
+        assert not os.path.exists(file_name)
+        assert_similar_figures(fig, figs[0])
+
+        # rendering works again afterwards
+        fig.savefig(file_name)
+        assert os.path.exists(file_name)
+
+@register_test()
+def test_text_list():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6], label="data")
+    ax.legend()
+    fig.supxlabel("x")
+    ref = Figure(fig).extract()
+    labels = ref.axes[0].xtick_label
+    assert isinstance(labels, TextList) and isinstance(labels[0], TextValue)
+    assert isinstance(ref.sup_xlabel, TextValue) and ref.sup_xlabel.text == "x"
+    assert ref.axes[0].legend_entries[0].get_text() == "data"
+
+    # references written with matplotlib Text objects still work
+    texts = [Text(*text.get_position(), text.get_text(), fontsize=text.get_size())
+             for text in labels]
+    assert TextList(texts).first_difference(labels) is None
+    namespace = vars(test_figures).copy()
+    namespace.update(array=np.array, float64=np.float64)
+    old_ref = eval(repr(ref).replace(repr(labels), repr(texts)), namespace)
+    assert isinstance(old_ref.axes[0].xtick_label, TextList)
+    assert_similar_figures(old_ref, fig)
+
+    other = TextList(list(labels)[:3] + [TextValue(0.0, 0.0, "wrong", 10.0)])
+    assert labels.first_difference(other) == 3
+    assert TextList([None, labels[0]]).first_difference(TextList([None, None])) == 1
+    assert TextList([None]).first_difference(TextList([None])) is None
+
+@register_test()
+def test_compact_primitives():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6])
+    ax.scatter([1, 2], [3, 4])
+    ax.bar([1, 2], [3, 4])
+    ax.add_patch(plt.Circle((1, 1), 2))
+    ref = Figure(fig).extract()
+    axis = ref.axes[0]
+    for item in [axis.lines[0], axis.path_collections[0]] + list(axis.patches):
+        assert not hasattr(item, "__dict__")
+    copied = pickle.loads(pickle.dumps(ref))
+    assert_similar_figures(ref, copied)
+    assert copied.digest == ref.digest
+
+@register_test()
+def test_streaming_output():
+    plt.close("all")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = os.path.join(tmp_dir, "references")
+        refs = {}
+        with StreamingFigureOutput(directory) as output:
+            for i in range(3):
+                fig, ax = plt.subplots()
+                ax.plot([1, 2, 3], [4, 5, i])
+                refs[f"fig_{i}"] = Figure(fig).extract()
+                output.write_to_file(fig, f"fig_{i}")
+                # the figure is written and closed straight away
+                assert f"fig_{i}" in output
+                assert not plt.get_fignums()
+        assert sorted(os.listdir(directory)) == ["fig_0.npz", "fig_1.npz", "fig_2.npz"]
+
+        loaded = load_figures(directory)
+        assert sorted(loaded) == ["fig_0", "fig_1", "fig_2"]
+        for name, ref in refs.items():
+            assert_similar_figures(ref, loaded[name])
+
+        # resuming keeps the figures already written
+        output = StreamingFigureOutput(directory)
+        assert output.fig_names() == ["fig_0", "fig_1", "fig_2"]
+        output = StreamingFigureOutput(directory, resume=False)
+        assert output.fig_names() == [] and "fig_0" not in output
+
+@register_test()
+def test_matching():
+    plt.close("all")
+    # a difference well within the tolerance changes the order the lines,
+    # scatter plots and bars sort in
+    figs = []
+    for shift in (0, 2e-9):
+        fig, ax = plt.subplots()
+        ax.plot([shift, 1, 2], [5, 5, 5], c='k')
+        ax.plot([1e-9, 1, 2], [0, 0, 0], c='k')
+        ax.scatter([shift, 1], [5, 5], c='k')
+        ax.scatter([1e-9, 1], [0, 0], c='k')
+        ax.bar([shift, 1e-9], [1, 2], width=0.5, color='k')
+        figs.append(fig)
+    ref, other = Figure(figs[0]), Figure(figs[1])
+    ax, other_ax = ref.axes[0], other.axes[0]
+    assert ax.lines[0].y_data[0] != other_ax.lines[0].y_data[0]
+    assert ax.path_collections[0].y_data[0] != other_ax.path_collections[0].y_data[0]
+    assert ax.patches.height[0] != other_ax.patches.height[0]
+
+    attrs_list = (("x_data", "y_data"), ("height", "position_x"), None)
+    for attrs in attrs_list:
+        assert_similar_figures(ref, other, attrs)
+        try:
+            assert_similar_figures(ref, other, attrs, matching="sorted")
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("Sorted lines shouldn't be similar")
+
+    # lines which really are different still fail
+    figs[1].axes[0].lines[0].set_ydata([5, 5, 6])
+    try:
+        assert_similar_figures(figs[0], figs[1], ("y_data",))
+    except AssertionError as err:
+        assert "isn't where it should be" in str(err)
+    else:
+        raise AssertionError("Different lines should fail")
+
+    # pairs which are already similar are only compared once
+    fig, ax = plt.subplots()
+    for i in range(5):
+        ax.plot([1, 2, 3], [i, i, i])
+    calls = []
+    first_difference = test_figures.first_difference
+    test_figures.first_difference = lambda *args, **kwargs: (
+        calls.append(1) or first_difference(*args, **kwargs))
+    try:
+        assert_similar_figures(fig, fig, ("x_data", "y_data"))
+    finally:
+        test_figures.first_difference = first_difference
+    assert len(calls) == 10, len(calls)
+
+@register_test()
+def test_line_envelopes():
+    plt.close("all")
+    x = np.arange(100000)
+    y = np.sin(x / 1000)
+    spiked = y.copy()
+    spiked[54321] = 2
+    figs = []
+    for y_data in (y, y, spiked):
+        fig, ax = plt.subplots()
+        ax.plot(x, y_data)
+        ax.plot([1, 2, 3], [4, 5, 6])
+        figs.append(fig)
+    ref = Figure(figs[0]).extract().build_envelopes(block=256)
+    long_line, short_line = ref.axes[0].lines
+    assert long_line.envelopes is not None and short_line.envelopes is None
+    assert_similar_figures(ref, figs[1], ("x_data", "y_data"))
+    try:
+        assert_similar_figures(ref, figs[2], ("x_data", "y_data"))
+    except AssertionError as err:
+        assert "First difference in y_data at index 54321" in str(err)
+    else:
+        raise AssertionError("The spike should be found")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sizes = {}
+        for envelope_only in (False, True):
+            file_name = os.path.join(tmp_dir, f"ref_{envelope_only}.npz")
+            with FigureOutput(file_name, envelope_block=256,
+                              envelope_only=envelope_only) as output:
+                output.write_to_file(figs[0], "fig")
+            sizes[envelope_only] = os.path.getsize(file_name)
+            loaded = Figure.load(file_name)
+            assert_similar_figures(loaded, figs[1])
+            try:
+                assert_similar_figures(loaded, figs[2], ("y_data",))
+            except AssertionError as err:
+                index = 54321 if not envelope_only else 54321 // 256 * 256
+                assert f"at index {index}" in str(err)
+            else:
+                raise AssertionError("The spike should be found")
+        assert sizes[True] < sizes[False] / 10
+
+@register_test()
+def test_columnar_export():
+    plt.close("all")
+    cohort = {}
+    for i in range(3):
+        fig, ax = plt.subplots()
+        ax.plot([1, 2, 3], [4, 5, i], c="r" if i else "b", label="data")
+        ax.plot([1, 2], [3, 4], c="k")
+        ax.scatter([1, 2, 3, 4], [i, i, i, i])
+        ax.bar([1, 2], [3, i])
+        ax.legend()
+        other_fig = plt.figure()
+        cohort[f"student_{i}"] = [Figure(fig), Figure(other_fig)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_columnar(cohort, tmp_dir)
+        for mmap in (False, True):
+            tables = load_columnar(tmp_dir, mmap=mmap)
+            figures, lines = tables["figures"], tables["lines"]
+            assert len(figures["submission"]) == 6
+            assert list(figures["num_axes"]) == [1, 0] * 3
+            assert len(tables["axes"]["submission"]) == 3
+            assert len(lines["colour"]) == 6
+            assert sorted(set(lines["colour"])) == ["#000000", "#0000ff", "#ff0000"]
+            # the y data of the red and blue lines
+            y_data = [lines["y_data"][lines["offsets"][i]:lines["offsets"][i + 1]]
+                      for i in np.flatnonzero(lines["label"] == "data")]
+            assert [list(y) for y in y_data] == [[4, 5, i] for i in range(3)]
+            pcs = tables["path_collections"]
+            assert list(np.diff(pcs["offsets"])) == [4, 4, 4]
+            assert list(tables["patches"]["kind"]) == ["rectangle"] * 6
+            texts = tables["texts"]
+            legends = texts["attr"] == "legend_entries"
+            assert list(texts["text"][legends]) == ["data"] * 3
+
+        # figures from older reference files, which have no size
+        # and older ones still, missing most attributes
+        sparse = Figure({"axes": [test_figures.Axis({"lines": []})]})
+        legacy_dir = os.path.join(tmp_dir, "legacy")
+        export_columnar({"legacy": test_hist, "sparse": sparse}, legacy_dir)
+        tables = load_columnar(legacy_dir)
+        assert np.isnan(tables["figures"]["width"]).all()
+        axes = tables["axes"]
+        assert list(axes["grid_rows"]) == [1, -1]
+        assert list(axes["has_title"]) == [0, -1]
+        assert list(axes["num_legend_entries"]) == [0, -1]
+        assert list(axes["title"]) == ["", ""]
+
+@register_test()
+def test_diff_figures():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6], c="r")
+    ax.plot([1, 2, 3], [1, 1, 1], c="b")
+    ax.bar([1, 2, 3], [1, 2, 3])
+    ax.set_title("Title")
+    other_fig, other_ax = plt.subplots()
+    other_ax.plot([1, 2, 3], [4, 5, 6.5], c="r")
+    other_ax.plot([1, 2, 3], [1, 1, 1], c="g")
+    other_ax.bar([1, 2, 3], [1, 2.25, 4])
+    other_ax.set_title("Other title")
+
+    differences = diff_figures(fig, other_fig, ("x_data", "y_data", "colour",
+                                                "height", "title"))
+    found = {(d.path, d.attr): d for d in differences}
+    assert set(found) == {(("axes", 0), "title"),
+                          (("axes", 0, "lines", 0), "colour"),
+                          (("axes", 0, "lines", 1), "y_data"),
+                          (("axes", 0, "patches", 1), "height"),
+                          (("axes", 0, "patches", 2), "height")}, found
+    assert found[("axes", 0), "title"].error is None
+    assert np.isclose(found[("axes", 0, "lines", 1), "y_data"].error, 0.5)
+    assert np.isclose(found[("axes", 0, "patches", 1), "height"].error, 0.25)
+    assert diff_figures(fig, fig) == []
+
+    # assert_similar_figures raises the first difference diff_figures finds,
+    # with the same message
+    try:
+        assert_similar_figures(fig, other_fig, ("y_data",))
+    except AssertionError as error:
+        message = str(error)
+    else:
+        raise AssertionError("The figures should differ")
+    assert [d.message for d in diff_figures(fig, other_fig, ("y_data",))] == [message]
+
+    # when the numbers differ the items aren't compared
+    other_ax.plot([1, 2], [3, 4])
+    differences = diff_figures(fig, other_fig, ("x_data", "y_data"))
+    assert [(d.attr, d.expected, d.found) for d in differences] == [("lines", 2, 3)]
+
+@register_test()
+def test_score_figures():
+    plt.close("all")
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3], [4, 5, 6], c="r")
+    ax.plot([1, 2, 3], [1, 1, 1], c="b")
+    ax.bar([1, 2, 3], [1, 2, 3])
+    ax.set_title("Title")
+    other_fig, other_ax = plt.subplots()
+    other_ax.plot([1, 2, 3], [4, 5, 7], c="r")
+    other_ax.plot([1, 2, 3], [1, 1, 1], c="g")
+    other_ax.bar([1, 2, 3], [1, 2, 5])
+    other_ax.set_title("Title")
+
+    rubric = {"y_data": 2, "colour": 1, "height": 1, "title": 1, "radius": 1}
+    result = score_figures(fig, other_fig, rubric)
+    expected = {"y_data": 0.5, "colour": 0.5, "height": 2 / 3, "title": 1,
+                "radius": 1}
+    assert result.scores.keys() == expected.keys()
+    for attr, score in expected.items():
+        assert np.isclose(result.scores[attr], score), (attr, result.scores)
+    assert np.isclose(result.score, (1 + 0.5 + 2 / 3 + 1 + 1) / 6)
+    assert result.errors["y_data"]["max_abs"] == 1
+    assert np.isclose(result.errors["y_data"]["rms"], np.sqrt(1 / 6))
+    assert result.errors["height"]["max_abs"] == 2
+    assert "radius" not in result.errors
+    assert len(result.differences) == 3
+
+    result = score_figures(fig, fig, rubric)
+    assert result.score == 1
+    assert result.errors["y_data"] == {"max_abs": 0, "rms": 0}
+
+    # lines can't be paired if there are more of them, so they score 0
+    other_ax.plot([1, 2], [3, 4])
+    result = score_figures(fig, other_fig, rubric)
+    assert result.scores["y_data"] == 0 and result.scores["colour"] == 0
+    assert result.scores["title"] == 1
+
+    try:
+        score_figures(fig, other_fig, {"colour": 1, "color": 1})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("An unknown attribute should raise a ValueError")
+
+@register_test()
+def test_benchmarks_run():
+    from benchmark_figures import run_benchmarks
+    results = run_benchmarks((2,), (100,), (5,), (10,), repeat=1)
+    timings = results["cases"][0]["results"]
+    assert timings["compare_all"]["repeat"] == 1
+    assert timings["binary_reference_bytes"] > 0
+
+    # importing the benchmarks leaves the backend alone
+    code = ("import matplotlib, benchmark_figures; "
+            "print(matplotlib.get_backend())")
+    env = dict(os.environ, MPLBACKEND="svg")
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout.strip() == "svg", output.stdout
+
 if __name__ == "__main__":
     plt.ion()
     run_tests()